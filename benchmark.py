@@ -0,0 +1,478 @@
+""" @file benchmark.py
+    @author Sean Duffie
+    @brief Timing comparisons for the Database wrapper
+
+    Run directly to print events/sec for each storage strategy and the lookup cost
+    as a table grows, using throwaway databases in a temporary directory so nothing
+    in ./data/ is touched.
+
+    The suite mode times the storage layer on the real schema (schema.MIGRATIONS) against
+    synthetic clan histories of several sizes and writes the results as JSON, and the
+    compare mode diffs two of those files to catch regressions between commits:
+
+        python benchmark.py suite --sizes 10000 1000000 10000000 --out before.json
+        (checkout the other commit)
+        python benchmark.py suite --sizes 10000 1000000 10000000 --out after.json
+        python benchmark.py compare before.json after.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import pandas as pd
+
+from database import PERFORMANCE_PROFILE, Database, DatabaseWriter, to_epoch
+from records import TrophyRecord
+from schema import MIGRATIONS
+
+PLAYERS = 300
+CLANS = 6
+# Columns filled by suite_history_rows(), single changes leave the burst summary columns NULL
+SUITE_COLUMNS = ["Date", "ClanId", "PlayerId", "Trophies"]
+HISTORY_START = datetime.datetime(2020, 1, 1)
+TROPHY_INDEXES = [
+    ("PlayerTag", "Date", "Trophies"),
+    ("Clan", "Date")
+]
+TROPHY_TABLE = [
+    ("Date", "integer", ""),
+    ("Clan", "text", ""),
+    ("PlayerTag", "text", ""),
+    ("PlayerName", "text", ""),
+    ("Trophies", "int", "")
+]
+
+
+def fake_trophy_row(i: int) -> tuple:
+    """ Build a synthetic trophy event row """
+    return (
+        to_epoch(),
+        "#2LQGUYYQJ",
+        f"#P{i % 300:04d}",
+        f"Player{i % 300}",
+        4000 + i % 500
+    )
+
+
+def fake_history_rows(first: int, count: int) -> list:
+    """ Build synthetic trophy history, one event every 10 seconds across PLAYERS members
+
+    Args:
+        first (int): index of the first row, so successive calls continue the timeline
+        count (int): number of rows to build
+
+    Returns:
+        list: row tuples in time order
+    """
+    rows = []
+    for i in range(first, first + count):
+        rows.append((
+            to_epoch(HISTORY_START) + 10 * i,
+            "#2LQGUYYQJ",
+            f"#P{i % PLAYERS:04d}",
+            f"Player{i % PLAYERS}",
+            4000 + i % 500
+        ))
+    return rows
+
+
+def fake_member(i: int) -> SimpleNamespace:
+    """ Stand-in for coc.ClanMember with just the attributes the records read """
+    return SimpleNamespace(
+        clan=SimpleNamespace(tag="#2LQGUYYQJ"),
+        tag=f"#P{i % PLAYERS:04d}",
+        name=f"Player{i % PLAYERS}",
+        trophies=4000 + i % 500
+    )
+
+
+def bench_dataframe_row(count: int) -> float:
+    """ The old handler pattern: one-row DataFrame, itertuples, take the first row
+
+    Args:
+        count (int): number of events to simulate
+
+    Returns:
+        float: microseconds per event
+    """
+    members = [fake_member(i) for i in range(count)]
+    start = time.perf_counter()
+    for member in members:
+        df = pd.DataFrame([[to_epoch(), member.clan.tag, member.tag, member.name, member.trophies]])
+        for _ in df.itertuples(index=False, name=None):
+            break
+    return (time.perf_counter() - start) / count * 1e6
+
+
+def bench_record_row(count: int) -> float:
+    """ Building the row as a TrophyRecord
+
+    Args:
+        count (int): number of events to simulate
+
+    Returns:
+        float: microseconds per event
+    """
+    members = [fake_member(i) for i in range(count)]
+    start = time.perf_counter()
+    for member in members:
+        TrophyRecord.from_member(member)
+    return (time.perf_counter() - start) / count * 1e6
+
+
+def bench_reconnect_per_event(db_path: str, count: int) -> float:
+    """ The old handler pattern: open, insert one row, close
+
+    Args:
+        db_path (str): directory to store the benchmark database in
+        count (int): number of events to simulate
+
+    Returns:
+        float: events per second
+    """
+    db = Database("reconnect.db", db_path)
+    db.create_table("trophies", TROPHY_TABLE)
+    db.close()
+
+    start = time.perf_counter()
+    for i in range(count):
+        db.create_connection("reconnect.db", db_path)
+        db.insert_row("trophies", row=fake_trophy_row(i))
+        db.close()
+    elapsed = time.perf_counter() - start
+    return count / elapsed
+
+
+def bench_persistent(db_path: str, count: int) -> float:
+    """ One long-lived connection shared by every event
+
+    Args:
+        db_path (str): directory to store the benchmark database in
+        count (int): number of events to simulate
+
+    Returns:
+        float: events per second
+    """
+    db = Database("persistent.db", db_path, persistent=True)
+    db.create_table("trophies", TROPHY_TABLE)
+
+    start = time.perf_counter()
+    for i in range(count):
+        db.insert_row("trophies", row=fake_trophy_row(i))
+    elapsed = time.perf_counter() - start
+    db.close()
+    return count / elapsed
+
+
+def bench_buffered(db_path: str, count: int) -> float:
+    """ Persistent connection with rows batched through the write buffer
+
+    Args:
+        db_path (str): directory to store the benchmark database in
+        count (int): number of events to simulate
+
+    Returns:
+        float: events per second
+    """
+    db = Database("buffered.db", db_path, persistent=True, buffer_rows=200, buffer_ms=2000)
+    db.create_table("trophies", TROPHY_TABLE)
+
+    start = time.perf_counter()
+    for i in range(count):
+        db.buffer_row("trophies", row=fake_trophy_row(i))
+    db.flush()
+    elapsed = time.perf_counter() - start
+    db.close()
+    return count / elapsed
+
+
+def bench_writer(db_path: str, count: int) -> float:
+    """ Rows handed to the background writer thread, including the final drain
+
+    Args:
+        db_path (str): directory to store the benchmark database in
+        count (int): number of events to simulate
+
+    Returns:
+        float: events per second
+    """
+    db = Database("writer.db", db_path)
+    db.create_table("trophies", TROPHY_TABLE)
+    db.close()
+
+    writer = DatabaseWriter("writer.db", db_path, max_queue=count, batch_rows=200, batch_ms=2000)
+    writer.start()
+    start = time.perf_counter()
+    for i in range(count):
+        writer.submit("trophies", row=fake_trophy_row(i))
+    writer.stop()
+    elapsed = time.perf_counter() - start
+    return count / elapsed
+
+
+def bench_lookup_growth(db_path: str, sizes: list, indexed: bool, lookups: int = 50) -> list:
+    """ Grows a trophies table and times one player's week of history at each size
+
+    Args:
+        db_path (str): directory to store the benchmark database in
+        sizes (list): row counts to measure at, ascending
+        indexed (bool): create the bot's trophy indexes
+        lookups (int, optional): queries averaged per size. Defaults to 50.
+
+    Returns:
+        list: (rows, milliseconds per lookup) for each size
+    """
+    db = Database(f"lookup_{'indexed' if indexed else 'scan'}.db", db_path, persistent=True)
+    db.create_table("trophies", TROPHY_TABLE, indexes=TROPHY_INDEXES if indexed else None)
+
+    results = []
+    rows = 0
+    for size in sizes:
+        while rows < size:
+            chunk = min(100000, size - rows)
+            db.insert_many("trophies", fake_history_rows(rows, chunk))
+            rows += chunk
+
+        # Query the most recent week so every size reads the same amount of data
+        end = HISTORY_START + datetime.timedelta(seconds=10 * rows)
+        start_time = end - datetime.timedelta(days=7)
+        sql_format, params = db.build_select("trophies", columns=["Date", "Trophies"],
+                                             start=start_time, end=end)
+        sql_format += " AND PlayerTag = ?"
+
+        start = time.perf_counter()
+        for i in range(lookups):
+            db.cursor.execute(sql_format, params + [f"#P{i % PLAYERS:04d}"]).fetchall()
+        elapsed = time.perf_counter() - start
+        results.append((rows, elapsed / lookups * 1000))
+    db.close()
+    return results
+
+
+def suite_history_rows(first: int, count: int, player_ids: list, clan_ids: list) -> list:
+    """ Build synthetic history for the real trophies table, one event every 10 seconds
+
+    Members are spread evenly over CLANS clans and each one's trophies drift over time,
+    so every row has a distinct natural key.
+
+    Args:
+        first (int): index of the first row, so successive calls continue the timeline
+        count (int): number of rows to build
+        player_ids (list): PlayerId of each synthetic member
+        clan_ids (list): ClanId of each synthetic clan
+
+    Returns:
+        list: (Date, ClanId, PlayerId, Trophies) tuples in time order
+    """
+    base = to_epoch(HISTORY_START)
+    return [
+        (base + 10 * i, clan_ids[i % PLAYERS % CLANS], player_ids[i % PLAYERS], 4000 + (i // PLAYERS) % 500)
+        for i in range(first, first + count)
+    ]
+
+
+def median_ms(func, repeat: int) -> float:
+    """ Runs func repeat times and returns the median wall time
+
+    Args:
+        func (callable): operation to time
+        repeat (int): number of runs
+
+    Returns:
+        float: median milliseconds per run
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def bench_suite_size(db_path: str, size: int, events: int = 2000, repeat: int = 5) -> dict:
+    """ Times every storage path against one synthetic history of the given size
+
+    Metrics ending in _per_sec are throughputs (higher is better), the ones ending in
+    _ms are median latencies (lower is better). Reads use the newest data, so each size
+    returns about the same number of rows and only the table size differs.
+
+    Args:
+        db_path (str): directory to store the benchmark database in
+        size (int): rows of history to build
+        events (int, optional): rows written one at a time with insert_row(). Defaults to 2000.
+        repeat (int, optional): runs per read metric. Defaults to 5.
+
+    Returns:
+        dict: metric name -> value
+    """
+    db = Database(f"suite_{size}.db", db_path, persistent=True, profile=PERFORMANCE_PROFILE)
+    db.migrate(MIGRATIONS)
+    player_ids = [db.player_id(f"#P{p:04d}", f"Player{p}") for p in range(PLAYERS)]
+    clan_ids = [db.clan_id(f"#C{c}") for c in range(CLANS)]
+    results = {}
+
+    # Batched inserts, which also build the history for the read benchmarks
+    start = time.perf_counter()
+    rows = 0
+    while rows < size:
+        chunk = min(100000, size - rows)
+        db.insert_many("trophies", suite_history_rows(rows, chunk, player_ids, clan_ids), headers=SUITE_COLUMNS)
+        rows += chunk
+    results["insert_many_per_sec"] = size / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for row in suite_history_rows(size, events, player_ids, clan_ids):
+        db.insert_row("trophies", row=row, headers=SUITE_COLUMNS)
+    results["insert_row_per_sec"] = events / (time.perf_counter() - start)
+    rows += events
+
+    end = HISTORY_START + datetime.timedelta(seconds=10 * rows)
+    week = end - datetime.timedelta(days=7)
+    day = end - datetime.timedelta(days=1)
+    results["get_df_player_full_ms"] = median_ms(lambda: db.get_df("trophies", player_tag="#P0000"), repeat)
+    results["get_df_player_week_ms"] = median_ms(
+        lambda: db.get_df("trophies", player_tag="#P0000", start=week, end=end), repeat)
+    results["get_df_clan_day_ms"] = median_ms(
+        lambda: db.get_df("trophies", clan_tag="#C0", start=day, end=end), repeat)
+
+    start = time.perf_counter()
+    exported = db.export_csv("trophies", db_path, start=week, end=end)
+    results["export_csv_per_sec"] = exported / (time.perf_counter() - start)
+
+    results["raw_leaderboard_ms"] = median_ms(lambda: db.query_df(
+        "SELECT PlayerId, max(Trophies) AS Best FROM trophies WHERE Date >= ? GROUP BY PlayerId "
+        "ORDER BY Best DESC LIMIT 10", [to_epoch(week)]), repeat)
+    results["rollup_leaderboard_ms"] = median_ms(lambda: db.query_df(
+        "SELECT PlayerId, TrophyMax FROM player_weekly WHERE Date = (SELECT max(Date) FROM player_weekly) "
+        "ORDER BY TrophyMax DESC LIMIT 10"), repeat)
+
+    db.close()
+    results["file_mb"] = os.path.getsize(os.path.join(db_path, f"suite_{size}.db")) / 2**20
+    return results
+
+
+def run_suite(sizes: list, events: int = 2000, repeat: int = 5) -> dict:
+    """ Runs bench_suite_size() for every size in a temporary directory
+
+    Args:
+        sizes (list): history sizes in rows
+        events (int, optional): see bench_suite_size(). Defaults to 2000.
+        repeat (int, optional): see bench_suite_size(). Defaults to 5.
+
+    Returns:
+        dict: environment info and the metrics of each size, ready for json
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    report = {
+        "commit": commit,
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "pandas": pd.__version__,
+        "results": {}
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            print(f"Benchmarking {size} rows...", flush=True)
+            metrics = bench_suite_size(tmp, size, events=events, repeat=repeat)
+            report["results"][str(size)] = metrics
+            for name, value in metrics.items():
+                print(f"    {name:<24}: {value:12.2f}")
+    return report
+
+
+def compare_reports(base: dict, new: dict, threshold: float = 0.10) -> list:
+    """ Prints every metric of two suite reports side by side and lists the regressions
+
+    A throughput that dropped, or a latency that rose, by more than threshold counts as
+    a regression. file_mb is informational only.
+
+    Args:
+        base (dict): report of the reference commit
+        new (dict): report to check
+        threshold (float, optional): relative change tolerated. Defaults to 0.10.
+
+    Returns:
+        list: (size, metric, base value, new value) of each regression
+    """
+    print(f"{'rows':>10} {'metric':<24} {base.get('commit') or 'base':>12} {new.get('commit') or 'new':>12}  change")
+    regressions = []
+    for size, metrics in new["results"].items():
+        for name, value in metrics.items():
+            old = base["results"].get(size, {}).get(name)
+            if not old:
+                continue
+            change = value / old - 1
+            worse = -change if name.endswith("_per_sec") else change
+            flag = ""
+            if worse > threshold and name != "file_mb":
+                flag = "  REGRESSION"
+                regressions.append((size, name, old, value))
+            print(f"{size:>10} {name:<24} {old:12.2f} {value:12.2f} {change:+7.1%}{flag}")
+    return regressions
+
+
+def bench_strategies():
+    """ The original comparison of write strategies, row construction and index use """
+    EVENTS = 2000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, bench in [
+            ("reconnect per event", bench_reconnect_per_event),
+            ("persistent connection", bench_persistent),
+            ("buffered writes", bench_buffered),
+            ("background writer", bench_writer),
+        ]:
+            rate = bench(tmp, EVENTS)
+            print(f"{name:<24}: {rate:10.1f} events/sec ({EVENTS} events)")
+
+        print("\nPer-event row construction:")
+        print(f"{'pandas DataFrame':<24}: {bench_dataframe_row(EVENTS):10.2f} us/event")
+        print(f"{'TrophyRecord':<24}: {bench_record_row(EVENTS):10.2f} us/event")
+
+        SIZES = [10000, 100000, 1000000]
+        print("\nOne player's last week of trophies:")
+        for label, indexed in [("full scan", False), ("indexed", True)]:
+            for rows, ms in bench_lookup_growth(tmp, SIZES, indexed):
+                print(f"{label:<10} {rows:>9} rows: {ms:8.3f} ms/lookup")
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description="Timing comparisons for the Database wrapper")
+    MODES = PARSER.add_subparsers(dest="mode")
+    MODES.add_parser("strategies", help="compare write strategies (default)")
+    SUITE = MODES.add_parser("suite", help="time the storage layer and write the results as json")
+    SUITE.add_argument("--sizes", type=int, nargs="+", default=[10000, 1000000, 10000000])
+    SUITE.add_argument("--events", type=int, default=2000, help="rows written one at a time")
+    SUITE.add_argument("--repeat", type=int, default=5, help="runs per read metric")
+    SUITE.add_argument("--out", default=None, help="json file for the results")
+    COMPARE = MODES.add_parser("compare", help="diff two suite json files")
+    COMPARE.add_argument("base")
+    COMPARE.add_argument("new")
+    COMPARE.add_argument("--threshold", type=float, default=0.10, help="relative change tolerated")
+    ARGS = PARSER.parse_args()
+
+    if ARGS.mode == "suite":
+        REPORT = run_suite(ARGS.sizes, events=ARGS.events, repeat=ARGS.repeat)
+        if ARGS.out:
+            with open(ARGS.out, "w", encoding="utf-8") as out_file:
+                json.dump(REPORT, out_file, indent=4)
+    elif ARGS.mode == "compare":
+        with open(ARGS.base, encoding="utf-8") as base_file, open(ARGS.new, encoding="utf-8") as new_file:
+            REGRESSIONS = compare_reports(json.load(base_file), json.load(new_file), ARGS.threshold)
+        sys.exit(1 if REGRESSIONS else 0)
+    else:
+        bench_strategies()
@@ -15,12 +15,14 @@ import discord
 import discord.ext
 import discord.ext.commands
 import discord.ext.tasks
-import pandas as pd
 from coc import utils
 from dotenv import load_dotenv, set_key
 
 import log_format
-from database import Database
+from database import PERFORMANCE_PROFILE, Database, DatabaseWriter
+from recorder import EventRecorder
+from scheduler import PollScheduler
+from schema import MIGRATIONS
 
 ### PATH SECTION ###
 RTDIR = os.path.dirname(__file__)
@@ -29,37 +31,25 @@ LOGDIR = os.path.join(RTDIR, "logs")
 ENVDIR = os.path.join(RTDIR, ".env")
 
 ### DATABASE SECTION ###
-DB = Database("stats.db", DBDIR)
-DB.create_table(
-    t_name="roster",
-    cols=[
-        ("COC", "text", ""),
-        ("Discord", "text", "")
-    ]
-)
-DB.create_table(
-    t_name="trophies",
-    cols=[
-        ("Date", "text", ""),
-        ("Clan", "text", ""),
-        ("PlayerTag", "text", ""),
-        ("PlayerName", "text", ""),
-        ("Trophies", "int", "")
-    ]
-)
-DB.create_table(
-    t_name="donations",
-    cols=[
-        ("Date", "text", ""),
-        ("Clan", "text", ""),
-        ("DonorTag", "text", ""),
-        ("DonorName", "text", ""),
-        ("RecipientTag", "text", ""),
-        ("RecipientName", "text", ""),
-        ("Amount", "int", "")
-    ]
-)
-DB.close()
+RETENTION_DAYS = 30          # raw trophy/donation rows
+HOURLY_RETENTION_DAYS = 365  # hourly trophy summaries
+# Reports read through a small pool of read-only connections so they never touch the main connection,
+# and repeated report queries are answered from the result cache until the writer touches their tables
+DB = Database("stats.db", DBDIR, persistent=True, profile=PERFORMANCE_PROFILE, read_pool=4, cache_size=128)
+# Brings older database files up to the current schema (see schema.py), up to date files cost one query
+if not DB.migrate(MIGRATIONS):
+    sys.exit("Database migration failed, see the log for details")
+
+# Event rows are written by a background thread so handlers never block the event loop
+WRITER = DatabaseWriter("stats.db", DBDIR, max_queue=10000, batch_rows=200, batch_ms=2000,
+                        profile=PERFORMANCE_PROFILE)
+WRITER.start()
+# Trophy changes of a player within this many seconds are written as one row
+TROPHY_WINDOW = 60
+# Players are polled hot/warm/cold by recent activity, hotter around war, raid and clan games starts
+SCHEDULER = PollScheduler()
+# Builds the records of member events, the same way as the supervisor shards
+RECORDER = EventRecorder(WRITER.submit_record, window=TROPHY_WINDOW, scheduler=SCHEDULER)
 
 ### LOGGING SECTION ###
 logname = os.path.join(LOGDIR, f'clashbot_{datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}.log')
@@ -114,10 +104,57 @@ CHANNELS = {
 
 bot = discord.ext.commands.Bot(command_prefix="/", intents=discord.Intents.all())
 
+@discord.ext.tasks.loop(minutes=5)
+async def report_writer():
+    """ Logs the database writer's throughput and backpressure counters """
+    stats = WRITER.stats()
+    if stats["dropped"]:
+        logger.warning("Database writer: %s", stats)
+    else:
+        logger.debug("Database writer: %s", stats)
+    logger.debug("Report cache: %s", DB.cache_info())
+    logger.debug("Player polling: %s", SCHEDULER.stats())
+    # Keep the -wal file from growing unbounded between restarts
+    DB.checkpoint("PASSIVE")
+
+
+def run_retention():
+    """ Prunes old raw rows on its own connection, since sqlite objects are thread-bound """
+    retention_db = Database("stats.db", DBDIR, profile=PERFORMANCE_PROFILE)
+    retention_db.apply_retention(keep_days=RETENTION_DAYS, hourly_days=HOURLY_RETENTION_DAYS)
+    retention_db.close()
+
+
+@discord.ext.tasks.loop(seconds=10)
+async def flush_trophies():
+    """ Writes the trophy bursts whose coalescing window has closed """
+    RECORDER.flush_due()
+
+
+@discord.ext.tasks.loop(seconds=30)
+async def poll_players():
+    """ Rotates which players the coc client polls, see scheduler.PollScheduler """
+    SCHEDULER.apply(bot.coc_client)
+
+
+@discord.ext.tasks.loop(hours=24)
+async def database_retention():
+    """ Daily downsampling and pruning of raw event rows, run off the event loop """
+    await asyncio.to_thread(run_retention)
+
+
 @bot.event
 async def on_ready():
     """_summary_
     """
+    if not report_writer.is_running():
+        report_writer.start()
+    if not database_retention.is_running():
+        database_retention.start()
+    if not flush_trophies.is_running():
+        flush_trophies.start()
+    if not poll_players.is_running():
+        poll_players.start()
     await find_channels()
     msg = "Clash Stats has been started!"
     logger.info(msg)
@@ -140,21 +177,7 @@ async def on_clan_member_donation(old_member: coc.ClanMember, new_member: coc.Cl
         old_member (coc.ClanMember): _description_
         new_member (coc.ClanMember): _description_
     """
-    DB.create_connection("stats.db", DBDIR)
-    final_donated_troops = new_member.donations - old_member.donations
-    new_donations = pd.DataFrame([[
-            datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            new_member.clan.tag,
-            new_member.tag,
-            new_member.name,
-            "DonatedTag",
-            "DonatedName",
-            final_donated_troops
-    ]])
-    for row in new_donations.itertuples(index=False, name=None):
-        DB.insert_row("donations", row=row)
-        break
-    DB.close()
+    final_donated_troops = RECORDER.donated(old_member, new_member).Amount
 
     msg = "{} of {} just donated {} troops.".format(
             new_member,
@@ -182,21 +205,7 @@ async def on_clan_member_donation_receive(old_member: coc.ClanMember, new_member
         old_member (coc.ClanMember): _description_
         new_member (coc.ClanMember): _description_
     """
-    DB.create_connection("stats.db", DBDIR)
-    final_received_troops = new_member.received - old_member.received
-    new_donations = pd.DataFrame([[
-            datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            new_member.clan.tag,
-            "ReceivedTag",
-            "ReceivedName",
-            new_member.tag,
-            new_member.name,
-            final_received_troops
-    ]])
-    for row in new_donations.itertuples(index=False, name=None):
-        DB.insert_row("donations", row=row)
-        break
-    DB.close()
+    final_received_troops = RECORDER.received(old_member, new_member).Amount
 
     msg = "{} of {} just received {} troops.".format(
         new_member,
@@ -218,12 +227,14 @@ async def on_clan_member_donation_receive(old_member: coc.ClanMember, new_member
 async def on_clan_member_join(member: coc.ClanMember, clan: coc.Clan):
     """ Event Triggers when a member joins
 
-    TODO: Add to Roster (Roster Score 1)
+    Adds the member to the roster and starts polling them, hot at first.
 
     Args:
         member (coc.ClanMember): Member that joined
         clan (coc.Clan): Clan object
     """
+    RECORDER.joined(member, clan)
+
     msg = "{} has joined {}".format(
         member.name,
         clan.name
@@ -243,12 +254,14 @@ async def on_clan_member_join(member: coc.ClanMember, clan: coc.Clan):
 async def on_clan_member_leave(member: coc.ClanMember, clan: coc.Clan):
     """ Event Triggers when a member leaves
 
-    TODO: Set Roster Score to -1 for a day
+    Closes the member's roster row (Left date) and stops polling them.
 
     Args:
         member (coc.ClanMember): Member that left
         clan (coc.Clan): Clan object
     """
+    RECORDER.left(member, clan)
+
     msg = "{} has left {}".format(
         member.name,
         clan.name
@@ -297,24 +310,15 @@ async def clan_member_trophies_changed(old_member: coc.ClanMember, new_member: c
         old_member (coc.ClanMember): _description_
         new_member (coc.ClanMember): _description_
     """
-    DB.create_connection("stats.db", DBDIR)
-    new_trophies = pd.DataFrame([[
-        datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        new_member.clan.tag,
-        new_member.tag,
-        new_member.trophies
-    ]])
-    for row in new_trophies.itertuples(index=False, name=None):
-        DB.insert_row("trophies", row=row)
-        break
-    DB.close()
+    # Bursts are merged and logged by the recorder's coalescer
+    RECORDER.trophies(old_member, new_member)
 
     msg = "{} trophies changed from {} to {}".format(
         new_member,
         old_member.trophies,
         new_member.trophies
     )
-    logger.info(msg)
+    logger.debug(msg)
     # if CHANNELS["RANK"]:
     #     await bot.get_channel(CHANNELS["RANK"]).send(msg)
     # elif CHANNELS["DEFAULT"]:
@@ -389,6 +393,10 @@ async def new_war(war: coc.ClanWar):
     Args:
         war (coc.ClanWar): _description_
     """
+    # Poll the roster harder around battle day
+    if war.start_time is not None:
+        SCHEDULER.add_event(int(war.start_time.time.replace(tzinfo=datetime.timezone.utc).timestamp()))
+
     msg = f"New war against {war.opponent.name} detected."
     logger.info(msg)
     if CHANNELS["WARS"]:
@@ -557,9 +565,9 @@ async def main(clan_tags: List[str]) -> None:
         # Register all the clans you want to track
         coc_client.add_clan_updates(*clan_tags)
 
-        # Register all the players you want to track
-        async for clan in coc_client.get_clans(clan_tags):
-            coc_client.add_player_updates(*[member.tag for member in clan.members])
+        # Register all the players you want to track, the scheduler decides when each one is polled.
+        # The roster only needs the joins and leaves missed while offline, the member events keep it current
+        await RECORDER.follow(coc_client, clan_tags, DB.roster_members)
 
         # Register all the callback functions that are triggered when a
         # event if fired.
@@ -599,3 +607,9 @@ if __name__ == "__main__":
         loop.run_until_complete(main(clan_tags=CT))
     except KeyboardInterrupt:
         pass
+    finally:
+        RECORDER.flush_all()
+        WRITER.stop(timeout=30)
+        DB.optimize()
+        DB.checkpoint("TRUNCATE")
+        DB.close()
@@ -2,14 +2,31 @@
     @author Sean Duffie
     @brief A Python SQL wrapper class
 """
+import collections
+import contextlib
 import datetime
+import gzip
 import logging
 import os
+import pathlib
+import queue
+import re
+import shutil
 import sqlite3
 import sys
+import threading
+import time
 
 import pandas as pd
 
+try:
+    import pyarrow
+    import pyarrow.dataset
+    import pyarrow.parquet
+except ImportError:
+    # Only needed for the parquet/feather snapshots
+    pyarrow = None
+
 # from typing import Any, Dict, Protocol, Union
 # from typing_extensions import TypeAlias, Annotated
 
@@ -18,6 +35,155 @@ import pandas as pd
 # Initial Logger Settings
 logger = logging.getLogger("Clash")
 
+# Pragmas applied on connect when a Database is given profile=PERFORMANCE_PROFILE.
+# WAL lets readers (get_df, export_csv) run while the writer thread is committing.
+PERFORMANCE_PROFILE = {
+    "auto_vacuum": "INCREMENTAL",   # only takes effect on new files (or after a full VACUUM)
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -64000,       # negative is KiB, so ~64MB of page cache
+    "mmap_size": 268435456,     # 256MB
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000        # ms to wait on a lock instead of failing immediately
+}
+
+# Format the Date column used to be stored in, before it became integer epoch seconds (UTC)
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+# Columns that hold a player tag, searched by get_df(player_tag=...)
+TAG_COLUMNS = ("PlayerTag", "DonorTag", "RecipientTag")
+# Seconds per timestamp bucket in the trophies natural key. Date is when the bot saw the
+# change, so the key catches the same row submitted or imported twice, not a change the
+# API reports again later (see schema.TABLES)
+DEDUP_BUCKET = 60
+# Tables/views whose contents change when rows are written to the key table (triggers, joins),
+# so cached reads of them are invalidated too
+DEPENDENT_TABLES = {
+    "trophies": ("player_daily", "player_weekly", "trophies_named"),
+    "donations": ("player_daily", "player_weekly", "donations_named"),
+    "players": ("trophies_named", "donations_named"),
+    "clans": ("trophies_named", "donations_named")
+}
+# Per database file write generation of every table, shared by all Database objects in the
+# process (e.g. the DatabaseWriter thread and the reporting connection), see invalidate()
+_GENERATIONS = {}
+_GENERATIONS_LOCK = threading.Lock()
+# Integer surrogate keys that replace the tags in normalized tables, also searched by get_df()
+PLAYER_ID_COLUMNS = ("PlayerId", "DonorId", "RecipientId")
+# Applied schema versions, see migrate()
+MIGRATIONS_TABLE = "schema_migrations (Version integer PRIMARY KEY, Name text, Date integer)"
+# Used by normalize_table(): tag column -> (id column, dimension table, name column it replaces)
+NORMALIZED_COLUMNS = {
+    "Clan": ("ClanId", "clans", None),
+    "PlayerTag": ("PlayerId", "players", "PlayerName"),
+    "DonorTag": ("DonorId", "players", "DonorName"),
+    "RecipientTag": ("RecipientId", "players", "RecipientName")
+}
+
+# Dimension tables created by create_dimensions(), every tag is stored exactly once
+CLANS_TABLE = [
+    ("ClanId", "integer", "PRIMARY KEY"),
+    ("Tag", "text", "UNIQUE NOT NULL")
+]
+PLAYERS_TABLE = [
+    ("PlayerId", "integer", "PRIMARY KEY"),
+    ("Tag", "text", "UNIQUE NOT NULL"),
+    ("Name", "text", "")                    # latest known name
+]
+PLAYER_NAMES_TABLE = [
+    ("PlayerId", "integer", "NOT NULL"),
+    ("Name", "text", "NOT NULL"),
+    ("Date", "integer", "NOT NULL")         # first time the name was seen
+]
+
+# Read-only views that present the normalized event tables with tags and names again
+NAMED_VIEWS = {
+    "trophies_named": """SELECT t.Date, c.Tag AS Clan, p.Tag AS PlayerTag, p.Name AS PlayerName, t.Trophies,
+                                t.LastDate, t.TrophyFirst, t.TrophyMin, t.TrophyMax, t.Changes
+                         FROM trophies t
+                         JOIN clans c ON c.ClanId = t.ClanId
+                         JOIN players p ON p.PlayerId = t.PlayerId""",
+    "donations_named": """SELECT d.Date, c.Tag AS Clan, g.Tag AS DonorTag, g.Name AS DonorName,
+                                 r.Tag AS RecipientTag, r.Name AS RecipientName, d.Amount, d.Total
+                          FROM donations d
+                          JOIN clans c ON c.ClanId = d.ClanId
+                          LEFT JOIN players g ON g.PlayerId = d.DonorId
+                          LEFT JOIN players r ON r.PlayerId = d.RecipientId"""
+}
+
+# Rollup tables maintained by create_rollups(): name -> (period length, offset) in seconds.
+# Epoch 0 was a Thursday, so weeks are offset by 4 days to start on Monday 00:00 UTC.
+ROLLUPS = {
+    "player_daily": (86400, 0),
+    "player_weekly": (604800, 345600)
+}
+ROLLUP_TABLE = [
+    ("Date", "integer", "NOT NULL"),        # start of the period, epoch seconds
+    ("PlayerId", "integer", "NOT NULL"),
+    ("ClanId", "integer", ""),
+    ("Donated", "integer", "DEFAULT 0"),
+    ("Received", "integer", "DEFAULT 0"),
+    ("TrophyMin", "integer", ""),
+    ("TrophyMax", "integer", ""),
+    ("TrophyLast", "integer", ""),
+    ("TrophyLastDate", "integer", "")
+]
+
+# Hourly open/high/low/close summary of trophy rows older than the raw retention window
+TROPHY_HOURLY_TABLE = [
+    ("Date", "integer", "NOT NULL"),        # start of the hour, epoch seconds
+    ("ClanId", "integer", ""),
+    ("PlayerId", "integer", "NOT NULL"),
+    ("Open", "integer", ""),
+    ("High", "integer", ""),
+    ("Low", "integer", ""),
+    ("Close", "integer", ""),
+    ("Count", "integer", "")
+]
+
+
+def to_epoch(when: datetime.datetime = None) -> int:
+    """ Converts a datetime to the integer epoch seconds stored in Date columns
+
+    Naive datetimes are treated as local time, the same as datetime.timestamp().
+
+    Args:
+        when (datetime.datetime, optional): time to convert. Defaults to None (now).
+
+    Returns:
+        int: seconds since 1970-01-01 UTC
+    """
+    if when is None:
+        return int(time.time())
+    return int(when.timestamp())
+
+
+def index_name(t_name: str, cols: tuple, unique: bool = False) -> str:
+    """ Name create_index() gives an index, e.g. to drop one whose key changed
+
+    Args:
+        t_name (str): indexed table
+        cols (tuple): column names or expressions, in index order
+        unique (bool, optional): unique index. Defaults to False.
+
+    Returns:
+        str: index name
+    """
+    if isinstance(cols, str):
+        cols = (cols,)
+    return re.sub(r"\W+", "_", f"{'uq' if unique else 'idx'}_{t_name}_{'_'.join(cols)}").strip("_")
+
+
+def from_epoch(values) -> pd.Series:
+    """ Converts stored epoch seconds back into UTC pandas datetimes
+
+    Args:
+        values (pd.Series): integer epoch seconds
+
+    Returns:
+        pd.Series: timezone-aware (UTC) datetimes
+    """
+    return pd.to_datetime(values, unit="s", utc=True)
+
 
 class Database():
     """ This class serves as a wrapper for my SQL database.
@@ -26,28 +192,94 @@ class Database():
         Create Table
             from dataframe
             from headers
+            with composite keys and indexes
         Delete Table
         List Tables
         Export to pandas dataframe
-        Export to csv
+        Export to csv (streamed in chunks, optionally gzipped)
+        Export to / load from parquet and feather snapshots
+            filtered by columns, date range, player, clan and row limit
         Insert Row
-        Delete Row
-        TODO: Select cursor options
-            - Select Datetime range
+        Insert Many Rows
+        Idempotent inserts / upserts on natural keys
+        Bulk import of CSV/Parquet history
+        Buffered Inserts
+        Read connection pool for concurrent readers
+        Read result cache invalidated by writes
+        Delete Row / bulk delete by date range, player and clan (batched)
+        Checkpoint / Optimize
+        Versioned schema migrations
+        Migrate text dates to epoch seconds
+        Player/clan dimension tables and normalization to integer keys
+        Daily/weekly player rollups
+        Retention / downsampling
         FIXME: Table might need to be objectified
     """
-    def __init__(self, db_name: str = "my_database.db", db_path: str = "./") -> None:
+    def __init__(self, db_name: str = "my_database.db", db_path: str = "./", persistent: bool = False,
+                 buffer_rows: int = 0, buffer_ms: int = 0, profile: dict = None,
+                 read_pool: int = 0, read_timeout: float = 5.0, cache_size: int = 0) -> None:
         """ Constructor for the database class
         
         The SQLite3 connection and cursor are both constructed on initial setup, but if
         close() is ever called then it must be reopened using create_connection() later on.
 
+        In persistent mode the connection is kept open for the lifetime of the process. Every
+        operation health-checks it first and only reopens it if it has been closed or broken,
+        so callers never need to call create_connection() or close() around each operation.
+
+        Rows passed to buffer_row() are queued per table and written with executemany in a
+        single transaction once buffer_rows rows or buffer_ms milliseconds have accumulated.
+
+        With read_pool > 0, reads (get_df, exports) check out one of up to read_pool extra
+        read-only connections instead of using self.con, see reader().
+
+        With cache_size > 0, get_df() and query_df() results are kept in an LRU cache and
+        reused until a write to one of the tables they read from, see invalidate().
+
         Args:
             fname (str): filename for the database to store to and read from
+            persistent (bool, optional): keep one long-lived connection. Defaults to False.
+            buffer_rows (int, optional): flush the write buffer at this many rows.
+                                            Defaults to 0 (buffering disabled).
+            buffer_ms (int, optional): flush the write buffer once its oldest row is this old.
+                                            Defaults to 0 (no time limit).
+            profile (dict, optional): pragmas applied on every connect, see PERFORMANCE_PROFILE.
+                                            Defaults to None (sqlite defaults).
+            read_pool (int, optional): maximum number of pooled read connections.
+                                            Defaults to 0 (reads share self.con).
+            read_timeout (float, optional): seconds to wait for a free read connection. Defaults to 5.0.
+            cache_size (int, optional): maximum number of cached read results. Defaults to 0 (no cache).
         """
         # Generate the connection to the database file, if there is no file then create a new one
         self.db_name = db_name
         self.db_path = db_path
+        self.persistent = persistent
+        self.buffer_rows = buffer_rows
+        self.buffer_ms = buffer_ms
+        self.profile = profile or {}
+        self._pending = {}
+        self._pending_count = 0
+        self._pending_since = None
+        self._insert_sql = {}
+        self._columns = {}
+        self._clan_ids = {}
+        self._players = {}
+        # Rows removed by the last delete_row() call, including batches committed before a failure
+        self.deleted_rows = 0
+        self.read_pool = read_pool
+        self.read_timeout = read_timeout
+        self._readers = queue.LifoQueue()
+        self._reader_slots = threading.BoundedSemaphore(read_pool) if read_pool > 0 else None
+        self._reader_local = threading.local()
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._results = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+        with _GENERATIONS_LOCK:
+            self._generations = _GENERATIONS.setdefault(os.path.abspath(os.path.join(db_path, db_name)), {})
+        self.con = None
+        self.cursor = None
         self.create_connection(db_file=db_name, db_path=db_path)
         if self.con is None or self.cursor is None:
             logger.error("Failed to make connection!")
@@ -68,26 +300,201 @@ class Database():
             self.con = sqlite3.connect(os.path.join(db_path, db_file))
             # Create a cursor
             self.cursor = self.con.cursor()
+            self.apply_profile()
             logger.info("Database Connection Created!")
         except sqlite3.Error as e:
             print(e)
             logger.error("Failed to create connection!")
             sys.exit()
+        return self.con
+
+    def apply_profile(self):
+        """ Applies the pragma profile to the current connection
+
+        Pragmas are per connection (journal_mode=WAL is also persisted in the file), so this
+        runs on every create_connection().
+        """
+        for pragma, value in self.profile.items():
+            self.cursor.execute(f"PRAGMA {pragma} = {value}")
+            result = self.cursor.fetchone()
+            if pragma == "journal_mode" and result is not None and str(result[0]).upper() != str(value).upper():
+                logger.warning("Requested journal_mode %s but database is using %s", value, result[0])
+
+    def checkpoint(self, mode: str = "PASSIVE") -> tuple:
+        """ Runs a WAL checkpoint, copying committed pages from the -wal file back into the database
+
+        PASSIVE never blocks readers or writers; TRUNCATE also shrinks the -wal file to zero,
+        which is best done during quiet periods.
+
+        Args:
+            mode (str, optional): PASSIVE, FULL, RESTART or TRUNCATE. Defaults to "PASSIVE".
+
+        Returns:
+            tuple: (busy, wal pages, pages checkpointed), or None on failure
+        """
+        if mode.upper() not in ("PASSIVE", "FULL", "RESTART", "TRUNCATE"):
+            logger.error("Invalid checkpoint mode %s!", mode)
+            return None
+        self._auto_reconnect()
+        try:
+            self.cursor.execute(f"PRAGMA wal_checkpoint({mode.upper()})")
+            return self.cursor.fetchone()
+        except sqlite3.Error as e:
+            print(e)
+            logger.error("Failed to checkpoint database!")
+            return None
+
+    def optimize(self) -> bool:
+        """ Lets sqlite refresh query planner statistics for tables that need it
+
+        Cheap enough to run periodically or before closing a long-lived connection.
+
+        Returns:
+            bool: Success
+        """
+        self._auto_reconnect()
+        try:
+            self.cursor.execute("PRAGMA optimize")
+            return True
+        except sqlite3.Error as e:
+            print(e)
+            logger.error("Failed to optimize database!")
+            return False
+
+    def is_connected(self) -> bool:
+        """ Cheap health check of the current connection
+
+        Touching total_changes raises ProgrammingError on a closed connection without
+        running any SQL, so this is safe to call before every operation.
+
+        Returns:
+            bool: Is the connection open and usable?
+        """
+        if self.con is None or self.cursor is None:
+            return False
+        try:
+            _ = self.con.total_changes
+            return True
+        except sqlite3.Error:
+            return False
+
+    def ensure_connection(self) -> sqlite3.Connection:
+        """ Reopens the connection only if it is missing or broken
+
+        Returns:
+            sqlite3.Connection: The live sqlite object
+        """
+        if not self.is_connected():
+            if self.con is not None:
+                logger.warning("Database connection lost, reconnecting...")
+            self.create_connection(db_file=self.db_name, db_path=self.db_path)
+        return self.con
+
+    def _auto_reconnect(self):
+        """ In persistent mode, make sure the connection is usable before touching it """
+        if self.persistent:
+            self.ensure_connection()
+
+    def _open_reader(self) -> sqlite3.Connection:
+        """ Opens a read-only connection for the read pool
+
+        Only the per connection cache/mmap/temp/busy pragmas of the profile are applied,
+        the rest (journal_mode, synchronous, ...) belong to the writer.
+
+        Returns:
+            sqlite3.Connection: new read-only connection, usable from any thread
+        """
+        uri = pathlib.Path(self.db_path, self.db_name).absolute().as_uri() + "?mode=ro"
+        con = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        for pragma in ("cache_size", "mmap_size", "temp_store", "busy_timeout"):
+            if pragma in self.profile:
+                con.execute(f"PRAGMA {pragma} = {self.profile[pragma]}")
+        return con
+
+    @contextlib.contextmanager
+    def reader(self, timeout: float = None):
+        """ Checks out a read connection for the calling thread
+
+        Under WAL, pooled readers see the last committed data and never block (or get
+        blocked by) the writer, so report commands can run in a thread pool in parallel
+        with ingestion. Connections are opened lazily, at most read_pool of them, and reused
+        LIFO. A thread that already holds one gets the same connection back, so nested
+        reads don't use up extra slots. Without a pool this just yields self.con.
+
+        Example:
+            with db.reader() as con:
+                top = pd.read_sql("SELECT * FROM player_weekly ORDER BY Donated DESC LIMIT 10", con)
+
+        Args:
+            timeout (float, optional): seconds to wait for a free connection. Defaults to read_timeout.
+
+        Raises:
+            sqlite3.OperationalError: if no connection frees up within the timeout
+
+        Yields:
+            sqlite3.Connection: connection to read from
+        """
+        held = getattr(self._reader_local, "con", None)
+        if held is not None:
+            yield held
+            return
+        if self._reader_slots is None:
+            self._auto_reconnect()
+            yield self.con
+            return
 
-    def create_table(self, t_name: str, cols, ref: tuple = None) -> bool:
+        if not self._reader_slots.acquire(timeout=self.read_timeout if timeout is None else timeout):
+            raise sqlite3.OperationalError(f"timed out waiting for one of {self.read_pool} read connections")
+        try:
+            try:
+                con = self._readers.get_nowait()
+            except queue.Empty:
+                con = self._open_reader()
+            self._reader_local.con = con
+            try:
+                yield con
+            finally:
+                self._reader_local.con = None
+                try:
+                    _ = con.total_changes
+                    self._readers.put(con)
+                except sqlite3.Error:
+                    # Closed while checked out, don't hand it to the next thread
+                    pass
+        finally:
+            self._reader_slots.release()
+
+    def close_readers(self):
+        """ Closes the idle pooled read connections, new ones are opened on demand """
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def create_table(self, t_name: str, cols, ref: tuple = None, primary_key: tuple = None,
+                     indexes: list = None, unique: list = None, duplicates: str = None) -> bool:
         """ Create a new table from scratch with a given set of headers
 
+        Indexes are created with IF NOT EXISTS, so adding one to the spec of an existing
+        table builds it on the next startup.
+
         Example:
             table = [
                 ("name", "text", "NOT NULL"),
                 ("begin_date", "text", ""),
                 ("end_date", "text", "")
             ]
+            db.create_table("events", table, indexes=[("name", "begin_date")])
 
         Args:
             t_name (str): table name, used to access the specific data table in the database
             cols (list): if creating a new table, specify the header names. Defaults to None.
             ref (tuple, optional): reference table
+            primary_key (tuple, optional): column(s) forming a composite primary key
+            indexes (list, optional): tuples of column names, one index per tuple
+            unique (list, optional): tuples of columns/expressions, one unique index (natural key) per tuple
+            duplicates (str, optional): existing rows that break a unique key, see create_index()
 
         Returns:
             bool: Was the table created successfully?
@@ -99,6 +506,8 @@ class Database():
                 t_cols += f"{ent[0]} {ent[1]} {ent[2]}"
             else:
                 t_cols += f"{ent[0]} {ent[1]} {ent[2]},\n"
+        if primary_key:
+            t_cols += f",\nPRIMARY KEY ({', '.join(primary_key)})"
 
         # Format the SQL string command that will be executed
         if ref is not None:
@@ -123,15 +532,167 @@ class Database():
         #                             );"""
 
         # Attempt to execute the specified
+        self._auto_reconnect()
         try:
             self.cursor.execute(sql_table_formatted)
             self.con.commit()
-            return True
+            self.forget_statements(t_name)
         except sqlite3.Error as e:
             print(e)
             logger.error("Failed to create table from scratch!")
             return False
 
+        for index_cols in indexes or []:
+            if not self.create_index(t_name, index_cols):
+                return False
+        for key_cols in unique or []:
+            if not self.create_index(t_name, key_cols, unique=True, duplicates=duplicates):
+                return False
+        return True
+
+    def create_index(self, t_name: str, cols: tuple, unique: bool = False, duplicates: str = None) -> bool:
+        """ Creates an index over one or more columns of a table, if it doesn't exist yet
+
+        Put the equality filter columns first and the range column (usually Date) after
+        them; trailing extra columns make the index covering for queries that only read them.
+
+        A unique index can't be built over rows that already break it. What happens to
+        them depends on duplicates:
+            None    - nothing is changed, the conflicting keys are logged and this fails
+            "purge" - all but the earliest copy of each key are deleted, only for event
+                      tables where duplicates are replays of the same event
+            "merge" - see merge_duplicates(), for hand-curated tables
+
+        Args:
+            t_name (str): table to index
+            cols (tuple): column names or expressions, in index order
+            unique (bool, optional): reject duplicate keys. Defaults to False.
+            duplicates (str, optional): "purge" or "merge", see above. Defaults to None.
+
+        Returns:
+            bool: Success
+        """
+        if isinstance(cols, str):
+            cols = (cols,)
+        idx_name = index_name(t_name, cols, unique)
+        sql_format = (f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {idx_name} "
+                      f"ON {t_name} ({', '.join(cols)});")
+
+        self._auto_reconnect()
+        try:
+            try:
+                self.cursor.execute(sql_format)
+            except sqlite3.IntegrityError:
+                if duplicates == "purge":
+                    self.cursor.execute(f"""DELETE FROM {t_name} WHERE rowid NOT IN (
+                                                SELECT min(rowid) FROM {t_name} GROUP BY {', '.join(cols)})""")
+                    logger.warning("Removed %d duplicate rows from %s before adding key %s",
+                                   self.cursor.rowcount, t_name, idx_name)
+                elif duplicates != "merge" or not self.merge_duplicates(t_name, cols):
+                    raise
+                self.cursor.execute(sql_format)
+            self.con.commit()
+            return True
+        except sqlite3.IntegrityError as e:
+            print(e)
+            self.con.rollback()
+            self.cursor.execute(f"SELECT {', '.join(cols)}, count(*) FROM {t_name} GROUP BY {', '.join(cols)} "
+                                "HAVING count(*) > 1 LIMIT 10")
+            logger.error("Failed to create index %s, duplicate keys: %s", idx_name, self.cursor.fetchall())
+            return False
+        except sqlite3.Error as e:
+            print(e)
+            self.con.rollback()
+            logger.error("Failed to create index %s!", idx_name)
+            return False
+
+    def merge_duplicates(self, t_name: str, cols: tuple) -> bool:
+        """ Collapses rows that share a key into one row, ahead of a unique index on it
+
+        Rows are only merged when they don't disagree: every column keeps the one non-NULL
+        value its copies have. If two copies hold different values in the same column,
+        nothing is changed and the keys are logged, so the caller fails instead of losing
+        data someone entered by hand. Runs in the caller's transaction.
+
+        Args:
+            t_name (str): table holding the duplicates
+            cols (tuple): key column names
+
+        Returns:
+            bool: True if every duplicate was merged
+        """
+        key = ", ".join(f'"{c}"' for c in cols)
+        not_null = " AND ".join(f'"{c}" IS NOT NULL' for c in cols)
+        others = [c for c in self.table_columns(t_name) if c not in cols]
+        disagree = " OR ".join(f'count(DISTINCT "{c}") > 1' for c in others) or "0"
+        self.cursor.execute(f"SELECT {key} FROM {t_name} WHERE {not_null} GROUP BY {key} "
+                            f"HAVING count(*) > 1 AND ({disagree})")
+        conflicts = self.cursor.fetchall()
+        if conflicts:
+            logger.error("Can't merge rows of %s that disagree, fix them by hand: %s", t_name, conflicts)
+            return False
+
+        merged = ", ".join(f'max("{c}") AS "{c}"' for c in self.table_columns(t_name))
+        self.cursor.execute(f"CREATE TEMP TABLE merged AS SELECT {merged} FROM {t_name} WHERE {not_null} "
+                            f"GROUP BY {key} HAVING count(*) > 1")
+        self.cursor.execute(f"DELETE FROM {t_name} WHERE ({key}) IN (SELECT {key} FROM temp.merged)")
+        removed = self.cursor.rowcount
+        self.cursor.execute(f"INSERT INTO {t_name} SELECT * FROM temp.merged")
+        logger.warning("Merged %d duplicate rows of %s into %d", removed, t_name, self.cursor.rowcount)
+        self.cursor.execute("DROP TABLE temp.merged")
+        return True
+
+    def create_tables(self, tables: dict) -> bool:
+        """ Creates every table of a declarative registry, see schema.TABLES
+
+        Tables that already exist get any columns declared since they were created. The
+        indexes are built last, since they may cover those new columns.
+
+        Args:
+            tables (dict): table name -> create_table() keyword arguments
+
+        Returns:
+            bool: Success
+        """
+        for t_name, spec in tables.items():
+            columns = {key: value for key, value in spec.items() if key not in ("indexes", "unique", "duplicates")}
+            if not (self.create_table(t_name, **columns) and self.add_columns(t_name, spec["cols"])):
+                return False
+            if not all(self.create_index(t_name, index_cols) for index_cols in spec.get("indexes", [])):
+                return False
+            if not all(self.create_index(t_name, key_cols, unique=True, duplicates=spec.get("duplicates"))
+                       for key_cols in spec.get("unique", [])):
+                return False
+        return True
+
+    def add_columns(self, t_name: str, cols: list) -> bool:
+        """ Adds the columns a table doesn't have yet, in one transaction
+
+        Args:
+            t_name (str): existing table
+            cols (list): (name, type, constraints) tuples, as for create_table()
+
+        Returns:
+            bool: Success (True if nothing was missing)
+        """
+        self._auto_reconnect()
+        known = self.table_columns(t_name)
+        missing = [col for col in cols if col[0] not in known]
+        if not missing:
+            return True
+        try:
+            self.cursor.execute("BEGIN")
+            for name, ctype, constraints in missing:
+                self.cursor.execute(f'ALTER TABLE {t_name} ADD COLUMN "{name}" {ctype} {constraints}')
+            self.con.commit()
+            self.forget_statements(t_name)
+            return True
+        except sqlite3.Error as e:
+            print(e)
+            self.con.rollback()
+            logger.error("Failed to add columns to table %s!", t_name)
+            return False
+
     def drop_table(self, t_name: str) -> bool:
         """ Deletes the specified table from the database
 
@@ -142,11 +703,13 @@ class Database():
             bool: Success or Failure
         """
         sql_format = f"DROP TABLE IF EXISTS {t_name};"
+        self._auto_reconnect()
 
         # Attempt to delete/drop the table, but catch any errors
         try:
             self.cursor.execute(sql_format)
             self.con.commit()
+            self.forget_statements(t_name)
             return True
         except sqlite3.Error as e:
             print(e)
@@ -156,6 +719,7 @@ class Database():
     def list_tables(self):
         """ Lists all tables currently present in the database """
         sql_format = "SELECT name FROM sqlite_master WHERE type='table';"
+        self._auto_reconnect()
 
         try:
             self.cursor.execute(sql_format)
@@ -164,193 +728,1712 @@ class Database():
             print(e)
             logger.error("Failed to list tables!")
 
-    def insert_row(self, t_name: str, row, headers: str = ""):
-        """ Inserts a row into the specified table
+    def forget_statements(self, t_name: str = None):
+        """ Drops cached INSERT statements and column lists so they are rebuilt from the current schema
+
+        Args:
+            t_name (str, optional): only forget this table. Defaults to None (all tables).
+        """
+        if t_name is None:
+            self._insert_sql.clear()
+            self._columns.clear()
+        else:
+            for key in [k for k in self._insert_sql if k[0] == t_name]:
+                del self._insert_sql[key]
+            self._columns.pop(t_name, None)
+        # A recreated dimension table hands out new ids
+        if t_name in (None, "clans"):
+            self._clan_ids.clear()
+        if t_name in (None, "players"):
+            self._players.clear()
+        self.invalidate(t_name)
+
+    def invalidate(self, t_name: str = None):
+        """ Bumps a table's write generation, so cached reads of it (and of the tables that
+        depend on it, see DEPENDENT_TABLES) are recomputed on their next use
+
+        Every write path of this class calls it after committing. Generations are shared
+        by all Database objects on the same file in this process; writes from other
+        processes are not seen, so don't enable the cache in a process that only reads.
+
+        Args:
+            t_name (str, optional): table that was written. Defaults to None (everything).
+        """
+        t_name = "*" if t_name is None else t_name.lower()
+        with _GENERATIONS_LOCK:
+            for name in (t_name, *DEPENDENT_TABLES.get(t_name, ())):
+                self._generations[name] = self._generations.get(name, 0) + 1
+
+    def _cache_lookup(self, sql_format: str, params, namespace: str) -> tuple:
+        """ Looks a read up in the result cache
+
+        The key is the caller's namespace, the whitespace-normalized SQL and its parameters.
+        The namespace keeps results post-processed differently apart (get_df() converts
+        Date, query_df() doesn't). An entry is only used if none of the tables named after
+        FROM/JOIN have been written since it was stored.
+
+        Args:
+            sql_format (str): SELECT statement
+            params (list): its parameters
+            namespace (str): name of the calling method
+
+        Returns:
+            tuple: (cache key, current generations of the tables read, cached dataframe or None)
+        """
+        key = (namespace, " ".join(sql_format.split()), tuple(params or ()))
+        tables = sorted({t.lower() for t in re.findall(r"\b(?:FROM|JOIN)\s+(\w+)", sql_format, re.IGNORECASE)})
+        with _GENERATIONS_LOCK:
+            generations = tuple(self._generations.get(t, 0) for t in ["*", *tables])
+        with self._cache_lock:
+            entry = self._results.get(key)
+            if entry is not None and entry[0] == generations:
+                self._results.move_to_end(key)
+                self.cache_hits += 1
+                return key, generations, entry[1].copy()
+            self.cache_misses += 1
+        return key, generations, None
+
+    def _cache_store(self, key: tuple, generations: tuple, df: pd.DataFrame):
+        """ Adds a read result to the cache, evicting the least recently used entries
+
+        Args:
+            key (tuple): from _cache_lookup()
+            generations (tuple): from _cache_lookup(), taken before the query ran
+            df (pd.DataFrame): the result
+        """
+        with self._cache_lock:
+            self._results[key] = (generations, df.copy())
+            self._results.move_to_end(key)
+            while len(self._results) > self.cache_size:
+                self._results.popitem(last=False)
+
+    def cache_info(self) -> dict:
+        """ Result cache counters, for logging
+
+        Returns:
+            dict: hits, misses, entries and maxsize
+        """
+        with self._cache_lock:
+            return {"hits": self.cache_hits, "misses": self.cache_misses,
+                    "entries": len(self._results), "maxsize": self.cache_size}
+
+    def table_columns(self, t_name: str, con: sqlite3.Connection = None) -> list:
+        """ Returns the column names of a table, cached until the schema changes
 
-        TODO: Add Error handling for validating the row format
-        TODO: [Maybe?] Add a check to make sure there isn't duplicate data
+        Args:
+            t_name (str): name of the table
+            con (sqlite3.Connection, optional): connection to query on a cache miss,
+                                                e.g. a pooled reader. Defaults to self.con.
+
+        Returns:
+            list: column names in table order, empty if the table doesn't exist
+        """
+        cols = self._columns.get(t_name)
+        if cols is None:
+            cur = self.cursor if con is None else con.cursor()
+            cur.execute(f"PRAGMA table_info({t_name})")
+            cols = [info[1] for info in cur.fetchall()]
+            if cols:
+                self._columns[t_name] = cols
+        return cols
+
+    def insert_statement(self, t_name: str, headers="", on_conflict=None) -> tuple:
+        """ Returns the cached, parameterized INSERT statement for a table
+
+        The column list comes from the table itself (PRAGMA table_info) unless headers
+        narrows it down, and every value is bound through a ? placeholder. Reusing the
+        exact same SQL string lets sqlite3's statement cache skip re-parsing it.
+
+        on_conflict decides what happens when a row hits a unique key (see create_table):
+            None      - plain INSERT, the row is rejected with an error
+            "ignore"  - ON CONFLICT DO NOTHING, the existing row wins (replays become no-ops)
+            (columns) - upsert, ON CONFLICT (columns) DO UPDATE the other columns to the new row
+
+        Args:
+            t_name (str): Name of the table to be modified
+            headers (str | list, optional): "(Date, Clan)" or ["Date", "Clan"].
+                                                Defaults to all columns of the table.
+            on_conflict (str | tuple, optional): conflict handling, see above. Defaults to None.
+
+        Returns:
+            tuple: (sql string, number of columns expected per row)
+        """
+        if on_conflict is not None and not isinstance(on_conflict, str):
+            on_conflict = tuple(on_conflict)
+        key = (t_name, headers if isinstance(headers, str) else tuple(headers), on_conflict)
+        cached = self._insert_sql.get(key)
+        if cached is not None:
+            return cached
+
+        if isinstance(headers, str):
+            cols = [h.strip() for h in headers.strip("() ").split(",") if h.strip()]
+        else:
+            cols = list(headers)
+        if not cols:
+            cols = self.table_columns(t_name)
+        if not cols:
+            raise sqlite3.OperationalError(f"no such table: {t_name}")
+
+        col_list = ", ".join(f'"{c}"' for c in cols)
+        placeholders = ", ".join("?" * len(cols))
+        sql_format = f"INSERT INTO {t_name} ({col_list}) VALUES ({placeholders})"
+        if on_conflict == "ignore":
+            sql_format += " ON CONFLICT DO NOTHING"
+        elif on_conflict is not None:
+            updates = ", ".join(f'"{c}" = excluded."{c}"' for c in cols if c not in on_conflict)
+            action = f"DO UPDATE SET {updates}" if updates else "DO NOTHING"
+            sql_format += f" ON CONFLICT ({', '.join(on_conflict)}) {action}"
+        cached = (sql_format, len(cols))
+        self._insert_sql[key] = cached
+        return cached
+
+    def insert_row(self, t_name: str, row, headers="", on_conflict=None) -> bool:
+        """ Inserts a row into the specified table
 
         Args:
             t_name (str): Name of the table to be modified
-            row (list): Row to be appended to the table
+            row (tuple): Row to be appended to the table
+            headers (str | list, optional): columns the row fills. Defaults to all columns.
+            on_conflict (str | tuple, optional): "ignore" or upsert key, see insert_statement()
 
         Returns:
             bool: Success
         """
-        sql_format = f"INSERT INTO {t_name} {headers} VALUES {row}"
+        return self.insert_many(t_name, rows=[row], headers=headers, on_conflict=on_conflict)
+
+    def insert_many(self, t_name: str, rows, headers="", on_conflict=None) -> bool:
+        """ Inserts several rows into the specified table in one transaction
+
+        Args:
+            t_name (str): Name of the table to be modified
+            rows (list): Rows to be appended to the table
+            headers (str | list, optional): columns the rows fill. Defaults to all columns.
+            on_conflict (str | tuple, optional): "ignore" or upsert key, see insert_statement()
 
+        Returns:
+            bool: Success
+        """
+        self._auto_reconnect()
         try:
-            self.cursor.execute(sql_format)
+            sql_format, width = self.insert_statement(t_name, headers, on_conflict)
+            rows = [tuple(row) for row in rows]
+            for row in rows:
+                if len(row) != width:
+                    logger.error("Row %s does not match the %d columns of table %s!", row, width, t_name)
+                    return False
+            self.cursor.executemany(sql_format, rows)
             self.con.commit()
+            self.invalidate(t_name)
             return True
         except sqlite3.Error as e:
             print(e)
+            self.con.rollback()
             logger.error("Failed insert row into table %s!", t_name)
             return False
 
-    def delete_row(self, t_name: str, index: int):
-        """ Deletes row at specified index
-        
-        TODO: Add error handling for certain index exceptions
-        TODO: Add ability to delete by datetime
+    def upsert_many(self, t_name: str, rows, key: tuple, headers="") -> bool:
+        """ Inserts rows, overwriting the other columns of any row with the same key
 
         Args:
             t_name (str): Name of the table to be modified
-            index (int): index of the row to be deleted
+            rows (list): Rows to be written
+            key (tuple): columns of a primary key or unique index on the table
+            headers (str | list, optional): columns the rows fill. Defaults to all columns.
 
         Returns:
             bool: Success
         """
-        sql_format = f"DELETE FROM {t_name} WHERE 'index' = {index}"
+        return self.insert_many(t_name, rows=rows, headers=headers, on_conflict=key)
 
-        try:
-            self.cursor.execute(sql_format)
-            self.con.commit()
-            return True
-        except sqlite3.Error as e:
-            print(e)
-            logger.error("Failed delete row from table %s at index %d!", t_name, index)
-            return False
+    def buffer_row(self, t_name: str, row, headers="", on_conflict=None) -> bool:
+        """ Queues a row for a later batched insert
 
-    def df_to_table(self, df: pd.DataFrame, t_name: str) -> bool:
-        """ Save a pandas dataframe to a table in the existing database
+        Falls straight through to insert_row() when buffering is disabled.
 
         Args:
-            df (pd.DataFrame): input pandas dataframe
-        
+            t_name (str): Name of the table to be modified
+            row (tuple): Row to be appended to the table
+            headers (str | list, optional): columns the row fills. Defaults to all columns.
+            on_conflict (str | tuple, optional): "ignore" or upsert key, see insert_statement()
+
         Returns:
-            bool: Success or not
+            bool: Success (of the flush, if one was triggered)
         """
-        # Attempt to create
+        if self.buffer_rows <= 0:
+            return self.insert_row(t_name, row=row, headers=headers, on_conflict=on_conflict)
+
+        # Reject malformed rows now rather than letting them fail the whole batch later
+        self._auto_reconnect()
         try:
-            df.to_sql(t_name, self.con, if_exists="fail", index=False)
-            self.con.commit()
-            return True
+            _, width = self.insert_statement(t_name, headers, on_conflict)
         except sqlite3.Error as e:
             print(e)
-            logger.error("Failed to create a table from dataframe!")
+            logger.error("Failed to buffer row for table %s!", t_name)
+            return False
+        row = tuple(row)
+        if len(row) != width:
+            logger.error("Row %s does not match the %d columns of table %s!", row, width, t_name)
             return False
 
-    def get_df(self, t_name: str) -> pd.DataFrame:
-        """ Returns a pandas dataframe retrieved from the database table
+        if on_conflict is not None and not isinstance(on_conflict, str):
+            on_conflict = tuple(on_conflict)
+        key = (t_name, headers if isinstance(headers, str) else tuple(headers), on_conflict)
+        self._pending.setdefault(key, []).append(row)
+        self._pending_count += 1
+        if self._pending_since is None:
+            self._pending_since = time.monotonic()
+
+        if self._pending_count >= self.buffer_rows:
+            return self.flush()
+        return self.flush_if_due()
 
-        TODO: add ability to control the rows/columns included in the dataframe
+    def buffer_record(self, record) -> bool:
+        """ Resolves a record from records.py to its stored row and queues it
+
+        Records with a write(db) method are applied right away instead, after flushing the
+        rows queued before them so changes land in order.
 
         Args:
-            t_name (str): name of the table being requested
+            record (NamedTuple): record with TABLE/COLUMNS/ON_CONFLICT attributes and a resolve(db) method,
+                                    or with a write(db) method
 
         Returns:
-            pd.DataFrame: database populated pandas dataframe
+            bool: Success
         """
-        df = pd.read_sql(
-            sql=f"select * from {t_name}",
-            con=self.con
-        )
-        df['Date'] = pd.to_datetime(df['Date'])
-
-        return df
+        if hasattr(record, "write"):
+            return self.flush() and record.write(self)
+        row = record.resolve(self)
+        if row is None:
+            logger.error("Failed to resolve %s!", record)
+            return False
+        return self.buffer_row(record.TABLE, row=row, headers=record.COLUMNS, on_conflict=record.ON_CONFLICT)
 
-    def export_csv(self, t_name: str, out_path: str = "."):
-        """ Generate a csv from a specified table
+    def flush_if_due(self) -> bool:
+        """ Flushes the write buffer if its oldest row has waited longer than buffer_ms
 
-        TODO: add ability to control the rows/columns going into the csv
+        Meant to be called periodically so quiet periods still get written out.
 
-        Args:
-            t_name (str): name of the table in the database, also serves as name of output csv file
-            out_path (str, optional): location of output csv. Defaults to ".".
+        Returns:
+            bool: Success
         """
-        df = self.get_df(t_name=t_name)
-        df.to_csv(f"{out_path}/{t_name}.csv", header=True, index=False)
+        if self._pending_since is None:
+            return True
+        if (time.monotonic() - self._pending_since) * 1000 >= self.buffer_ms:
+            return self.flush()
+        return True
 
-    def custom_sql_command(self, cmd: str):
-        """ This is a custom function for me to test new sql functions
+    def flush(self) -> bool:
+        """ Writes every buffered row with executemany inside one transaction
 
-        Args:
-            cmd (str): pre-formatted SQL string command
+        If the transaction fails it is rolled back and the buffered rows are dropped, so a
+        single malformed row can't wedge the buffer forever.
 
         Returns:
-            bool: Success or failure
+            bool: Success
         """
+        if self._pending_count == 0:
+            return True
+        self._auto_reconnect()
+        if not self.is_connected():
+            logger.error("Cannot flush %d buffered rows, connection is closed!", self._pending_count)
+            return False
+
+        pending = self._pending
+        count = self._pending_count
+        self._pending = {}
+        self._pending_count = 0
+        self._pending_since = None
+
         try:
-            self.cursor.execute(cmd)
+            for (t_name, headers, on_conflict), rows in pending.items():
+                sql_format, _ = self.insert_statement(t_name, headers, on_conflict)
+                self.cursor.executemany(sql_format, rows)
             self.con.commit()
+            for t_name in {key[0] for key in pending}:
+                self.invalidate(t_name)
             return True
         except sqlite3.Error as e:
             print(e)
-            logger.error("Custom SQL command failed!")
+            self.con.rollback()
+            logger.error("Failed to flush %d buffered rows!", count)
             return False
 
-    def close(self):
-        """ Close the connection (Usually not needed)
-            Database must call create_connection again to be usable
-        """
-        self.cursor.close()
-        self.con.close()
+    def delete_row(self, t_name: str, index: int = None, start: datetime.datetime = None,
+                   end: datetime.datetime = None, player_tag: str = None, clan_tag: str = None,
+                   batch_rows: int = 5000, pause: float = 0.0) -> bool:
+        """ Deletes a single row by rowid, or every row matching the get_df() filters
 
+        Bulk deletes run as repeated "DELETE ... WHERE rowid IN (SELECT ... LIMIT ?)"
+        statements, each committed on its own, so a large purge only ever holds the write
+        lock for one batch and live inserts can slip in between them. At least one filter
+        is required, so this can't be used to empty a table by accident, and index can't be
+        combined with the filters. Like retention, this leaves the rollup tables untouched.
+        The number of rows deleted is left in self.deleted_rows.
 
-def clean_old_set(csv_dir: str):
-    """ This function was used to convert the old dataset to the new Database format.
-        Shouldn't be needed anymore but is kept for reference.
-    """
-    def timeform(ts: str):
-        return datetime.datetime.strptime(ts, "%Y-%m-%d_%Hh")
-
-    dat = pd.read_csv(filepath_or_buffer=f"{csv_dir}/dat.csv")
-    # print(dat)
-    dat = dat.drop("Month", axis=1)
-    dat = dat.drop("Day", axis=1)
-    dat = dat.drop("Hour", axis=1)
-    dat = dat.drop("Amount Watered", axis=1)
-    dat = dat.drop("Watered?", axis=1)
-    dat = dat.drop("Days without water", axis=1)
-
-    dat["Date"] = dat["Date"].apply(timeform, 1)
-    # dat["Date"] = pd.to_datetime(dat["Date"])
-    return dat
+        Example:
+            # Drop everything a player logged in one clan during January
+            db.delete_row("trophies", start=datetime.datetime(2024, 1, 1),
+                          end=datetime.datetime(2024, 2, 1), player_tag="#2QJ9QJ8R", clan_tag="#2Y0YRGG0")
 
-if __name__ == "__main__":
-    DATASET = "clanname"
-
-    # Initialize Database
-    DB = Database(db_name=f"{DATASET}.db", db_path="./data/")
-
-    DB.drop_table(DATASET)
-
-    DF = clean_old_set(DB.db_path)
-    DB.df_to_table(df=DF, t_name=DATASET)
-
-    # Drop existing table for testing purposes
-    DB.list_tables()
-
-    # # Read data from old csv and populate table all at once
-    # df1 = pd.read_csv(filepath_or_buffer="./dat_aerogarden.csv")
-    # start = datetime.datetime.now()
-    # db.df_to_table(df=df1, t_name="AeroGarden")
-    # stop = datetime.datetime.now()
-    # # print(db.get_df("AeroGarden"))
-    # elapsed = stop-start
-    # count = df1.shape[0]
-    # print(f"Inserted {count} rows in {elapsed} seconds ({elapsed/count} per row)")
-
-    # # Read data from old csv and populate table one row at a time (significantly slower)
-    # table = [
-    #     ("Date", "text", ""),
-    #     ("Soil Moisture", "integer", ""),
-    #     ("Light Intensity", "integer", ""),
-    #     ("Temperature", "real", ""),
-    #     ("Humidity", "real", "")
-    # ]
-    # db.create_table("palm", table)
-    # df2 = pd.read_csv(filepath_or_buffer="./dat_palm.csv")
-    # # keys = f"{df2.keys().to_list()}".replace("[","(").replace("]",")").replace("'","")
-    # start = datetime.datetime.now()
-    # for pd_row in df2.itertuples(index=True, name=None):
-    #     print(type(pd_row))
-    #     db.insert_row(t_name="palm", row=pd_row)
-    # stop = datetime.datetime.now()
-    # # print(db.get_df("palm"))
-
-    # elapsed = stop-start
-    # count = df2.shape[0]
-    # print(f"Inserted {count} rows in {elapsed} seconds ({elapsed/count} per row)")
-    # db.list_tables()
+        Args:
+            t_name (str): Name of the table to be modified
+            index (int, optional): rowid of a single row to delete. Defaults to None.
+            start (datetime.datetime, optional): delete rows at or after this time. Defaults to None.
+            end (datetime.datetime, optional): delete rows before this time. Defaults to None.
+            player_tag (str, optional): only rows involving this player. Defaults to None.
+            clan_tag (str, optional): only rows from this clan. Defaults to None.
+            batch_rows (int, optional): rows deleted per transaction. Defaults to 5000.
+            pause (float, optional): seconds to sleep between batches. Defaults to 0.0.
+
+        Returns:
+            bool: Success
+        """
+        self.deleted_rows = 0
+        self._auto_reconnect()
+        try:
+            filtered = any(value is not None for value in (start, end, player_tag, clan_tag))
+            if index is not None and filtered:
+                raise sqlite3.OperationalError("delete_row takes either an index or filters, not both")
+            if index is not None:
+                where, params = ["rowid = ?"], [int(index)]
+            else:
+                where, params = self.build_filters(t_name, start, end, player_tag, clan_tag)
+            if not where:
+                raise sqlite3.OperationalError("delete_row needs an index or at least one filter")
+        except sqlite3.Error as e:
+            print(e)
+            logger.error("Failed delete rows from table %s!", t_name)
+            return False
+
+        sql_format = (f"DELETE FROM {t_name} WHERE rowid IN "
+                      f"(SELECT rowid FROM {t_name} WHERE {' AND '.join(where)} LIMIT ?)")
+        try:
+            while True:
+                self.cursor.execute(sql_format, (*params, batch_rows))
+                self.con.commit()
+                self.invalidate(t_name)
+                self.deleted_rows += self.cursor.rowcount
+                if self.cursor.rowcount < batch_rows:
+                    break
+                if pause:
+                    time.sleep(pause)
+        except sqlite3.Error as e:
+            print(e)
+            self.con.rollback()
+            logger.error("Failed delete rows from table %s after %d rows!", t_name, self.deleted_rows)
+            return False
+
+        logger.info("Deleted %d rows from %s", self.deleted_rows, t_name)
+        return True
+
+    def df_to_table(self, df: pd.DataFrame, t_name: str) -> bool:
+        """ Save a pandas dataframe to a table in the existing database
+
+        Args:
+            df (pd.DataFrame): input pandas dataframe
+        
+        Returns:
+            bool: Success or not
+        """
+        # Attempt to create
+        self._auto_reconnect()
+        try:
+            df.to_sql(t_name, self.con, if_exists="fail", index=False)
+            self.con.commit()
+            return True
+        except sqlite3.Error as e:
+            print(e)
+            logger.error("Failed to create a table from dataframe!")
+            return False
+
+    def bulk_import(self, t_name: str, path: str, chunksize: int = 100000, date_format: str = None,
+                    on_conflict="ignore", progress=None) -> int:
+        """ Streams a CSV or Parquet/Feather history file into an existing table
+
+        This is the fast path for seeding a new deployment from old exports. The file is
+        read in chunks and every chunk goes through one cached executemany, all inside a
+        single transaction. The table's plain indexes are dropped for the duration and
+        rebuilt once at the end, which is much cheaper than updating them row by row.
+        Unique indexes stay, so with on_conflict="ignore" rows that are already in the table
+        (overlapping exports, a second run) are skipped, and the rollup triggers only see
+        the rows that were actually added.
+
+        File columns are matched to the table by name and extra columns are ignored. Tag
+        columns (Clan, PlayerTag, ...) are turned into ClanId/PlayerId/... for normalized
+        tables, adding unknown clans/players (with their name) to the dimension tables.
+        Text dates are converted to epoch seconds, naive ones are read as local time.
+
+        Example:
+            db.bulk_import("trophies", "./exports/trophies.csv.gz")
+
+        Args:
+            t_name (str): existing table to import into
+            path (str): .csv/.csv.gz file, .parquet file or partitioned directory, or .feather file
+            chunksize (int, optional): rows read and inserted per chunk. Defaults to 100000.
+            date_format (str, optional): strptime format of text dates. Defaults to None (inferred).
+            on_conflict (str | tuple, optional): see insert_statement(). Defaults to "ignore".
+            progress (callable, optional): called with the running row count after each chunk
+
+        Returns:
+            int: number of rows read from the file, or -1 on failure
+        """
+        self._auto_reconnect()
+        known = self.table_columns(t_name)
+        if not known:
+            logger.error("Can't import into %s, the table doesn't exist!", t_name)
+            return -1
+        self.flush()
+
+        rows = 0
+        start = time.perf_counter()
+        try:
+            # Unique indexes (and the automatic primary key ones, with no sql) are kept
+            self.cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? "
+                                "AND sql IS NOT NULL AND sql NOT LIKE 'CREATE UNIQUE%'", (t_name,))
+            deferred = self.cursor.fetchall()
+            self.cursor.execute("BEGIN")
+            for idx_name, _ in deferred:
+                self.cursor.execute(f"DROP INDEX {idx_name}")
+
+            for df in self._read_chunks(path, chunksize):
+                df = self._import_frame(df, known, date_format)
+                if df.empty:
+                    continue
+                sql_format, _ = self.insert_statement(t_name, list(df.columns), on_conflict)
+                self.cursor.executemany(sql_format, df.itertuples(index=False, name=None))
+                rows += len(df)
+                if progress is not None:
+                    progress(rows)
+
+            for _, sql in deferred:
+                self.cursor.execute(sql)
+            self.con.commit()
+            for name in (t_name, "clans", "players"):
+                self.invalidate(name)
+        except (sqlite3.Error, OSError, ValueError, KeyError) as e:
+            print(e)
+            self.con.rollback()
+            # Dimension rows added by the failed import were rolled back too
+            self.forget_statements("clans")
+            self.forget_statements("players")
+            logger.error("Failed to import %s into table %s!", path, t_name)
+            return -1
+
+        elapsed = time.perf_counter() - start
+        logger.info("Imported %d rows into %s in %.1fs (%.0f rows/sec)",
+                    rows, t_name, elapsed, rows / elapsed if elapsed else 0)
+        return rows
+
+    def _read_chunks(self, path: str, chunksize: int):
+        """ Yields a history file as dataframes of at most chunksize rows
+
+        Args:
+            path (str): see bulk_import()
+            chunksize (int): rows per chunk
+
+        Yields:
+            pd.DataFrame: the next chunk
+        """
+        if path.endswith(".parquet") and not os.path.isdir(path):
+            if pyarrow is None:
+                raise ValueError("pyarrow is required to import parquet files")
+            for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunksize):
+                yield batch.to_pandas()
+        elif path.endswith(".feather") or os.path.isdir(path):
+            if pyarrow is None:
+                raise ValueError("pyarrow is required to import parquet/feather snapshots")
+            # Streamed like the single parquet file. Partition directory names aren't parsed,
+            # Month/ClanKey aren't table columns
+            dataset = pyarrow.dataset.dataset(path, format="feather" if path.endswith(".feather") else "parquet",
+                                              partitioning=None)
+            for batch in dataset.to_batches(batch_size=chunksize):
+                yield batch.to_pandas()
+        else:
+            yield from pd.read_csv(path, chunksize=chunksize)
+
+    def _import_frame(self, df: pd.DataFrame, known: list, date_format: str = None) -> pd.DataFrame:
+        """ Reshapes one chunk of an imported file into rows ready for the target table
+
+        Tags are resolved against the dimension tables without committing, so the ids
+        roll back together with the rest of the import.
+
+        Args:
+            df (pd.DataFrame): chunk as read from the file
+            known (list): columns of the target table
+            date_format (str, optional): see bulk_import()
+
+        Returns:
+            pd.DataFrame: only the table's columns, with None for missing values
+        """
+        df = df.copy()
+        for tag_col, (id_col, dimension, name_col) in NORMALIZED_COLUMNS.items():
+            if tag_col not in df.columns or tag_col in known or id_col not in known:
+                continue
+            tags = df[tag_col].where(df[tag_col].astype(str).str.startswith("#"))
+            if name_col in df.columns:
+                # First name seen for each tag in this chunk, only used for new players
+                names = df.loc[tags.notna(), [tag_col, name_col]].drop_duplicates(tag_col)
+                self.cursor.executemany("INSERT INTO players (Tag, Name) VALUES (?, ?) ON CONFLICT DO NOTHING",
+                                        names.itertuples(index=False, name=None))
+            else:
+                self.cursor.executemany(f"INSERT INTO {dimension} (Tag) VALUES (?) ON CONFLICT DO NOTHING",
+                                        ((tag,) for tag in tags.dropna().unique()))
+            self.cursor.execute(f"SELECT Tag, {id_col if dimension == 'clans' else 'PlayerId'} FROM {dimension}")
+            df[id_col] = tags.map(dict(self.cursor.fetchall()))
+
+        df = df[[c for c in known if c in df.columns]]
+        if "Date" in df.columns and not pd.api.types.is_integer_dtype(df["Date"]):
+            dates = pd.to_datetime(df["Date"], format=date_format)
+            if dates.dt.tz is None:
+                # Same as to_epoch() and migrate_epoch_dates(): naive times are local, resolved per value
+                # for DST. pd.Timestamp.timestamp() would read them as UTC, so go through datetime
+                epochs = {when: to_epoch(when.to_pydatetime()) for when in dates.dropna().unique()}
+                df["Date"] = dates.map(epochs)
+            else:
+                # Explicit unit, pandas may parse to s/ms/us resolution rather than ns
+                df["Date"] = ((dates - pd.Timestamp(0, tz="UTC")) // pd.Timedelta(seconds=1)).astype("Int64")
+        return df.astype(object).where(df.notna(), None)
+
+    def build_select(self, t_name: str, columns: list = None, start: datetime.datetime = None,
+                     end: datetime.datetime = None, player_tag: str = None, clan_tag: str = None,
+                     limit: int = None, con: sqlite3.Connection = None) -> tuple:
+        """ Builds a parameterized SELECT that pushes the get_df() filters into SQL
+
+        Column names are checked against the table so they can be safely formatted into
+        the statement, every value is bound through a ? placeholder.
+
+        Args:
+            t_name (str): name of the table being requested
+            columns (list, optional): see get_df()
+            start (datetime.datetime, optional): see get_df()
+            end (datetime.datetime, optional): see get_df()
+            player_tag (str, optional): see get_df()
+            clan_tag (str, optional): see get_df()
+            limit (int, optional): see get_df()
+            con (sqlite3.Connection, optional): connection to look the table up on. Defaults to self.con.
+
+        Returns:
+            tuple: (sql string, parameter list)
+        """
+        known = self.table_columns(t_name, con)
+        if not known:
+            raise sqlite3.OperationalError(f"no such table: {t_name}")
+
+        if columns:
+            unknown = [c for c in columns if c not in known]
+            if unknown:
+                raise sqlite3.OperationalError(f"no such column in {t_name}: {', '.join(unknown)}")
+            select = ", ".join(f'"{c}"' for c in columns)
+        else:
+            select = "*"
+
+        where, params = self.build_filters(t_name, start, end, player_tag, clan_tag, con)
+        sql_format = f"SELECT {select} FROM {t_name}"
+        if where:
+            sql_format += " WHERE " + " AND ".join(where)
+        if limit is not None:
+            sql_format += " LIMIT ?"
+            params.append(int(limit))
+        return sql_format, params
+
+    def build_filters(self, t_name: str, start: datetime.datetime = None, end: datetime.datetime = None,
+                      player_tag: str = None, clan_tag: str = None, con: sqlite3.Connection = None) -> tuple:
+        """ Builds the parameterized WHERE conditions shared by build_select() and delete_row()
+
+        Args:
+            t_name (str): name of the table being filtered
+            start (datetime.datetime, optional): see get_df()
+            end (datetime.datetime, optional): see get_df()
+            player_tag (str, optional): see get_df()
+            clan_tag (str, optional): see get_df()
+            con (sqlite3.Connection, optional): see build_select()
+
+        Returns:
+            tuple: (list of conditions to AND together, parameter list)
+        """
+        known = self.table_columns(t_name, con)
+        if not known:
+            raise sqlite3.OperationalError(f"no such table: {t_name}")
+
+        where = []
+        params = []
+        if start is not None:
+            where.append("Date >= ?")
+            params.append(to_epoch(start))
+        if end is not None:
+            where.append("Date < ?")
+            params.append(to_epoch(end))
+        if player_tag is not None:
+            # Normalized tables are matched on the integer id, looked up once by the subquery
+            tag_cols = [f"{c} = ?" for c in TAG_COLUMNS if c in known]
+            tag_cols += [f"{c} = (SELECT PlayerId FROM players WHERE Tag = ?)" for c in PLAYER_ID_COLUMNS if c in known]
+            if not tag_cols:
+                raise sqlite3.OperationalError(f"table {t_name} has no player tag column")
+            where.append("(" + " OR ".join(tag_cols) + ")")
+            params.extend([player_tag] * len(tag_cols))
+        if clan_tag is not None:
+            if "Clan" in known:
+                where.append("Clan = ?")
+            elif "ClanId" in known:
+                where.append("ClanId = (SELECT ClanId FROM clans WHERE Tag = ?)")
+            else:
+                raise sqlite3.OperationalError(f"table {t_name} has no clan column")
+            params.append(clan_tag)
+        return where, params
+
+    def get_df(self, t_name: str, columns: list = None, start: datetime.datetime = None,
+               end: datetime.datetime = None, player_tag: str = None, clan_tag: str = None,
+               limit: int = None) -> pd.DataFrame:
+        """ Returns a pandas dataframe retrieved from the database table
+
+        All filters are applied by sqlite, so only the requested rows and columns are ever
+        read into pandas. Reads go through reader(), so with a read pool this is safe to call
+        from report threads while the main connection keeps writing.
+
+        Example:
+            # One week of a single player's trophies
+            db.get_df("trophies", columns=["Date", "Trophies"], player_tag="#2QJ9QJ8R",
+                      start=datetime.datetime(2024, 1, 1), end=datetime.datetime(2024, 1, 8))
+
+        Args:
+            t_name (str): name of the table being requested
+            columns (list, optional): columns to include. Defaults to None (all columns).
+            start (datetime.datetime, optional): earliest Date included. Defaults to None.
+            end (datetime.datetime, optional): Date to stop before (exclusive). Defaults to None.
+            player_tag (str, optional): only rows where any tag column matches. Defaults to None.
+            clan_tag (str, optional): only rows from this clan. Defaults to None.
+            limit (int, optional): maximum number of rows. Defaults to None.
+
+        Returns:
+            pd.DataFrame: database populated pandas dataframe, Date as UTC datetimes
+        """
+        with self.reader() as con:
+            sql_format, params = self.build_select(t_name, columns=columns, start=start, end=end,
+                                                   player_tag=player_tag, clan_tag=clan_tag, limit=limit, con=con)
+            if self.cache_size > 0:
+                key, generations, df = self._cache_lookup(sql_format, params, "get_df")
+                if df is not None:
+                    return df
+            df = pd.read_sql(
+                sql=sql_format,
+                con=con,
+                params=params
+            )
+        if "Date" in df.columns:
+            df['Date'] = from_epoch(df['Date'])
+
+        if self.cache_size > 0:
+            self._cache_store(key, generations, df)
+        return df
+
+    def query_df(self, sql_format: str, params: list = None) -> pd.DataFrame:
+        """ Runs a read-only query (e.g. a leaderboard aggregate) through the read pool and result cache
+
+        Example:
+            # This week's top donors
+            db.query_df("SELECT PlayerId, Donated FROM player_weekly WHERE Date = ? ORDER BY Donated DESC LIMIT 10",
+                        [week_start])
+
+        Args:
+            sql_format (str): SELECT statement with ? placeholders
+            params (list, optional): values for the placeholders. Defaults to None.
+
+        Returns:
+            pd.DataFrame: the result, Date columns are left as stored
+        """
+        with self.reader() as con:
+            if self.cache_size > 0:
+                key, generations, df = self._cache_lookup(sql_format, params, "query_df")
+                if df is not None:
+                    return df
+            df = pd.read_sql(sql=sql_format, con=con, params=params)
+        if self.cache_size > 0:
+            self._cache_store(key, generations, df)
+        return df
+
+    def export_csv(self, t_name: str, out_path: str = ".", chunksize: int = 50000, compress: bool = False,
+                   progress=None, **filters) -> int:
+        """ Generate a csv from a specified table
+
+        Rows are streamed from sqlite in chunks and appended to the file as they arrive, so
+        memory use is bounded by chunksize regardless of how large the table is.
+
+        Args:
+            t_name (str): name of the table in the database, also serves as name of output csv file
+            out_path (str, optional): location of output csv. Defaults to ".".
+            chunksize (int, optional): rows read and written per chunk. Defaults to 50000.
+            compress (bool, optional): write {t_name}.csv.gz instead. Defaults to False.
+            progress (callable, optional): called with the running row count after each chunk
+            **filters: any of the get_df() keyword filters (columns, start, end, ...)
+
+        Returns:
+            int: number of rows written
+        """
+        rows = 0
+        with self.reader() as con:
+            # Build the query first, so an unknown table or column doesn't leave an empty file behind
+            sql_format, params = self.build_select(t_name, con=con, **filters)
+            if compress:
+                out_file = gzip.open(f"{out_path}/{t_name}.csv.gz", "wt", newline="", encoding="utf-8")
+            else:
+                out_file = open(f"{out_path}/{t_name}.csv", "w", newline="", encoding="utf-8")
+            with out_file:
+                for df in pd.read_sql(sql=sql_format, con=con, params=params, chunksize=chunksize):
+                    if "Date" in df.columns:
+                        df['Date'] = from_epoch(df['Date'])
+                    df.to_csv(out_file, header=rows == 0, index=False)
+                    rows += len(df)
+                    if progress is not None:
+                        progress(rows)
+        return rows
+
+    def export_snapshot(self, t_name: str, out_path: str = ".", fmt: str = "parquet", partition: bool = False,
+                        chunksize: int = 100000, **filters) -> int:
+        """ Export a table to a columnar Parquet or Feather snapshot with proper dtypes
+
+        Parquet is streamed chunk by chunk. With partition=True it is written as a dataset
+        directory split by Month (YYYY-MM) and ClanKey (the clan tag or id), so analytics can read just the slices
+        they need. Feather doesn't support appending or partitions, so it is written whole.
+        Every format replaces the previous snapshot of the table in out_path. Requires pyarrow.
+
+        Column dtypes come from the declared sqlite types (see _snapshot_dtypes()), not from
+        whatever a chunk happens to hold, so integer columns stay nullable Int64 even when
+        they are partly or entirely NULL. An empty table still writes a file with its schema.
+
+        Args:
+            t_name (str): name of the table, also the name of the output file/directory
+            out_path (str, optional): location of the snapshot. Defaults to ".".
+            fmt (str, optional): "parquet" or "feather". Defaults to "parquet".
+            partition (bool, optional): parquet dataset partitioned by month and clan. Defaults to False.
+            chunksize (int, optional): rows read per chunk. Defaults to 100000.
+            **filters: any of the get_df() keyword filters (columns, start, end, ...)
+
+        Returns:
+            int: number of rows written, or -1 on failure
+        """
+        if pyarrow is None:
+            logger.error("pyarrow is required to export %s snapshots!", fmt)
+            return -1
+        if fmt not in ("parquet", "feather"):
+            logger.error("Unknown snapshot format %s!", fmt)
+            return -1
+
+        if fmt == "feather":
+            with self.reader() as con:
+                dtypes = self._snapshot_dtypes(t_name, con)
+            df = self.get_df(t_name, **filters)
+            df = df.astype({c: dtype for c, dtype in dtypes.items() if c in df.columns})
+            df.to_feather(f"{out_path}/{t_name}.feather")
+            return len(df)
+
+        writer = None
+        schema = None
+        rows = 0
+        with self.reader() as con:
+            sql_format, params = self.build_select(t_name, con=con, **filters)
+            dtypes = self._snapshot_dtypes(t_name, con)
+            if partition and os.path.isdir(f"{out_path}/{t_name}"):
+                # to_parquet() adds files to an existing dataset, so a second export would double every row
+                shutil.rmtree(f"{out_path}/{t_name}")
+            try:
+                for df in pd.read_sql(sql=sql_format, con=con, params=params, chunksize=chunksize):
+                    if "Date" in df.columns:
+                        df['Date'] = from_epoch(df['Date'])
+                    df = df.astype({c: dtype for c, dtype in dtypes.items() if c in df.columns})
+                    if partition and df.empty:
+                        continue
+                    if partition:
+                        # Partition on copies so the real columns keep their order and dtype in the files
+                        cols = []
+                        if "Date" in df.columns:
+                            df["Month"] = df["Date"].dt.strftime("%Y-%m")
+                            cols.append("Month")
+                        clan_col = "Clan" if "Clan" in df.columns else "ClanId"
+                        if clan_col in df.columns:
+                            df["ClanKey"] = df[clan_col]
+                            cols.append("ClanKey")
+                        df.to_parquet(f"{out_path}/{t_name}", partition_cols=cols or None, index=False)
+                    else:
+                        # Pin the schema from the first chunk so all-null columns in later chunks still match
+                        table = pyarrow.Table.from_pandas(df, schema=schema, preserve_index=False)
+                        if writer is None:
+                            schema = table.schema
+                            writer = pyarrow.parquet.ParquetWriter(f"{out_path}/{t_name}.parquet", schema)
+                        writer.write_table(table)
+                    rows += len(df)
+                if partition and rows == 0:
+                    # No partitions to write, leave one file so the dataset still has the table's schema
+                    os.makedirs(f"{out_path}/{t_name}", exist_ok=True)
+                    empty = pd.read_sql(sql=f"SELECT * FROM ({sql_format}) LIMIT 0", con=con, params=params)
+                    if "Date" in empty.columns:
+                        empty['Date'] = from_epoch(empty['Date'])
+                    empty = empty.astype({c: dtype for c, dtype in dtypes.items() if c in empty.columns})
+                    empty.to_parquet(f"{out_path}/{t_name}/empty.parquet", index=False)
+            finally:
+                if writer is not None:
+                    writer.close()
+        return rows
+
+    def _snapshot_dtypes(self, t_name: str, con: sqlite3.Connection) -> dict:
+        """ Nullable pandas dtypes for a table's columns, from their declared sqlite types
+
+        Uses sqlite's type affinity rules. Date is left out, it is converted by from_epoch(),
+        and so are columns without a recognizable type, which keep what pandas infers.
+
+        Args:
+            t_name (str): table or view
+            con (sqlite3.Connection): connection to read the schema on
+
+        Returns:
+            dict: column name -> "Int64", "string" or "float64"
+        """
+        dtypes = {}
+        for _, name, ctype, *_ in con.execute(f"PRAGMA table_info({t_name})").fetchall():
+            ctype = (ctype or "").upper()
+            if name == "Date":
+                continue
+            if "INT" in ctype:
+                dtypes[name] = "Int64"
+            elif any(affinity in ctype for affinity in ("CHAR", "CLOB", "TEXT")):
+                dtypes[name] = "string"
+            elif any(affinity in ctype for affinity in ("REAL", "FLOA", "DOUB")):
+                dtypes[name] = "float64"
+        return dtypes
+
+    def load_snapshot(self, path: str, columns: list = None) -> pd.DataFrame:
+        """ Load a snapshot written by export_snapshot() back into a get_df() style dataframe
+
+        Args:
+            path (str): .parquet/.feather file or partitioned parquet directory
+            columns (list, optional): columns to read. Defaults to None (all columns).
+
+        Returns:
+            pd.DataFrame: the snapshot, with partition-only columns dropped
+        """
+        if pyarrow is None:
+            logger.error("pyarrow is required to load snapshots!")
+            return pd.DataFrame()
+
+        if path.endswith(".feather"):
+            return pd.read_feather(path, columns=columns)
+
+        if not os.path.isdir(path):
+            return pd.read_parquet(path, columns=columns)
+
+        # Month/ClanKey only exist to name the partition directories, so the directory names
+        # aren't parsed back into columns (they'd come back as dictionaries, not the stored dtypes)
+        df = pd.read_parquet(path, columns=columns, partitioning=None)
+        if "Date" in df.columns:
+            df = df.sort_values("Date", kind="stable").reset_index(drop=True)
+        return df
+
+    def _rollup_sql(self, r_name: str, source: str, new: str) -> list:
+        """ Builds the upserts that fold trophies/donations rows into one rollup table
+
+        The same statements serve the AFTER INSERT triggers (new="NEW.", one row) and the
+        rebuild from history (new="", every row of the source table in Date order).
+
+        Args:
+            r_name (str): rollup table name, a key of ROLLUPS
+            source (str): "trophies" or "donations"
+            new (str): column prefix, "NEW." inside a trigger
+
+        Returns:
+            list: SQL statements
+        """
+        length, offset = ROLLUPS[r_name]
+        period = f"({new}Date - (({new}Date - {offset}) % {length}))"
+        from_clause = "" if new else f"FROM {source} "
+        order = "" if new else "ORDER BY Date "
+
+        if source == "trophies":
+            return [f"""INSERT INTO {r_name} (Date, PlayerId, ClanId, TrophyMin, TrophyMax, TrophyLast, TrophyLastDate)
+                SELECT {period}, {new}PlayerId, {new}ClanId, coalesce({new}TrophyMin, {new}Trophies),
+                       coalesce({new}TrophyMax, {new}Trophies), {new}Trophies, coalesce({new}LastDate, {new}Date)
+                {from_clause}WHERE {new}PlayerId IS NOT NULL {order}
+                ON CONFLICT (PlayerId, Date) DO UPDATE SET
+                    ClanId = excluded.ClanId,
+                    TrophyMin = min(coalesce(TrophyMin, excluded.TrophyMin), excluded.TrophyMin),
+                    TrophyMax = max(coalesce(TrophyMax, excluded.TrophyMax), excluded.TrophyMax),
+                    TrophyLast = CASE WHEN TrophyLastDate IS NULL OR excluded.TrophyLastDate >= TrophyLastDate
+                                      THEN excluded.TrophyLast ELSE TrophyLast END,
+                    TrophyLastDate = max(coalesce(TrophyLastDate, excluded.TrophyLastDate), excluded.TrophyLastDate);"""]
+
+        # The other side of a donation is unknown and stored as NULL
+        return [f"""INSERT INTO {r_name} (Date, PlayerId, ClanId, {total})
+                SELECT {period}, {new}{player}, {new}ClanId, {new}Amount
+                {from_clause}WHERE {new}{player} IS NOT NULL {order}
+                ON CONFLICT (PlayerId, Date) DO UPDATE SET
+                    ClanId = excluded.ClanId,
+                    {total} = {total} + excluded.{total};"""
+                for player, total in (("DonorId", "Donated"), ("RecipientId", "Received"))]
+
+    def create_rollups(self) -> bool:
+        """ Creates the per player daily and weekly rollup tables and the triggers that feed them
+
+        Every row inserted into trophies or donations, by any write path, updates the
+        matching rollup rows in the same transaction, so reports read one row per member
+        per period instead of scanning the raw history. Newly created rollups are
+        backfilled from the existing history. The rollups use the same Date/PlayerId/ClanId
+        columns as the raw tables, so get_df() filters work on them unchanged.
+
+        Returns:
+            bool: Success
+        """
+        self._auto_reconnect()
+        existing = self.table_columns
+        for r_name in ROLLUPS:
+            is_new = not existing(r_name)
+            if not self.create_table(r_name, ROLLUP_TABLE, primary_key=("PlayerId", "Date"),
+                                     indexes=[("Date", "ClanId")]):
+                return False
+            try:
+                # Replaced every time, so existing files pick up changes to the statements
+                self.cursor.execute("BEGIN")
+                for source in ("trophies", "donations"):
+                    for i, sql in enumerate(self._rollup_sql(r_name, source, "NEW.")):
+                        self.cursor.execute(f"DROP TRIGGER IF EXISTS {r_name}_{source}_{i}")
+                        self.cursor.execute(f"""CREATE TRIGGER {r_name}_{source}_{i}
+                                                AFTER INSERT ON {source} BEGIN {sql} END;""")
+                self.con.commit()
+            except sqlite3.Error as e:
+                print(e)
+                self.con.rollback()
+                logger.error("Failed to create rollup triggers for %s!", r_name)
+                return False
+            if is_new and not self.rebuild_rollup(r_name):
+                return False
+        return True
+
+    def rebuild_rollup(self, r_name: str) -> bool:
+        """ Recomputes a rollup table from the full raw history in one transaction
+
+        Args:
+            r_name (str): rollup table name, a key of ROLLUPS
+
+        Returns:
+            bool: Success
+        """
+        self._auto_reconnect()
+        try:
+            self.cursor.execute("BEGIN")
+            self.cursor.execute(f"DELETE FROM {r_name}")
+            for source in ("trophies", "donations"):
+                if not self.table_columns(source):
+                    continue
+                for sql in self._rollup_sql(r_name, source, ""):
+                    self.cursor.execute(sql)
+            self.con.commit()
+            self.invalidate(r_name)
+            return True
+        except sqlite3.Error as e:
+            print(e)
+            self.con.rollback()
+            logger.error("Failed to rebuild rollup %s!", r_name)
+            return False
+
+    def apply_retention(self, keep_days: int = 30, hourly_days: int = 365, tables: tuple = ("trophies", "donations"),
+                        vacuum_pages: int = 2000) -> dict:
+        """ Downsamples and prunes raw event rows older than keep_days
+
+        Trophy rows are first folded into trophies_hourly (open/high/low/close/count per
+        player per hour), which itself is pruned after hourly_days; daily figures live on
+        in the player_daily/player_weekly rollups. Work is done one day at a time, each day
+        in its own transaction, so the write lock is never held for long. If the file uses
+        auto_vacuum=INCREMENTAL, up to vacuum_pages freed pages are returned to the OS.
+
+        Pruned rows are gone for good, so rebuild_rollup() can't recreate older periods
+        afterwards.
+
+        Args:
+            keep_days (int, optional): days of raw rows to keep. Defaults to 30.
+            hourly_days (int, optional): days of hourly trophy summaries to keep. Defaults to 365.
+            tables (tuple, optional): raw tables to prune. Defaults to ("trophies", "donations").
+            vacuum_pages (int, optional): pages to reclaim per run. Defaults to 2000.
+
+        Returns:
+            dict: rows deleted per table, plus "summarized" hourly rows written
+        """
+        self._auto_reconnect()
+        now = to_epoch()
+        # Day aligned cutoffs so an hour bucket is never split between two runs
+        cutoff = (now - keep_days * 86400) // 86400 * 86400
+        hourly_cutoff = (now - hourly_days * 86400) // 86400 * 86400
+        results = {"summarized": 0}
+
+        try:
+            if "trophies" in tables and self.table_columns("trophies"):
+                self.create_table("trophies_hourly", TROPHY_HOURLY_TABLE, primary_key=("PlayerId", "Date"),
+                                  indexes=[("Date", "ClanId")])
+            prune = [(t_name, cutoff) for t_name in tables if self.table_columns(t_name)]
+            if self.table_columns("trophies_hourly"):
+                prune.append(("trophies_hourly", hourly_cutoff))
+        except sqlite3.Error as e:
+            print(e)
+            logger.error("Failed to prepare retention!")
+            return results
+        summarize = """INSERT INTO trophies_hourly (Date, ClanId, PlayerId, Open, High, Low, Close, Count)
+            SELECT DISTINCT Hour, last_value(ClanId) OVER w, PlayerId, first_value(First) OVER w,
+                   max(High) OVER w, min(Low) OVER w, last_value(Trophies) OVER w, sum(Changes) OVER w
+            FROM (SELECT Date - Date % 3600 AS Hour, Date, ClanId, PlayerId, Trophies,
+                         coalesce(TrophyFirst, Trophies) AS First, coalesce(TrophyMax, Trophies) AS High,
+                         coalesce(TrophyMin, Trophies) AS Low, coalesce(Changes, 1) AS Changes
+                  FROM trophies WHERE Date >= ? AND Date < ? AND PlayerId IS NOT NULL)
+            WINDOW w AS (PARTITION BY PlayerId, Hour ORDER BY Date
+                         ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING)
+            ORDER BY Hour
+            ON CONFLICT (PlayerId, Date) DO UPDATE SET
+                ClanId = excluded.ClanId,
+                High = max(High, excluded.High),
+                Low = min(Low, excluded.Low),
+                Close = excluded.Close,
+                Count = Count + excluded.Count;"""
+
+        # A lock held past busy_timeout must not escape, the daily task loop would stop for good
+        for t_name, t_cutoff in prune:
+            results[t_name] = 0
+            try:
+                self.cursor.execute(f"SELECT min(Date) FROM {t_name} WHERE Date < ?", (t_cutoff,))
+                oldest = self.cursor.fetchone()[0]
+                while oldest is not None:
+                    day = oldest // 86400 * 86400
+                    end = min(day + 86400, t_cutoff)
+                    if t_name == "trophies":
+                        self.cursor.execute(summarize, (day, end))
+                        results["summarized"] += self.cursor.rowcount
+                    self.cursor.execute(f"DELETE FROM {t_name} WHERE Date >= ? AND Date < ?", (day, end))
+                    results[t_name] += self.cursor.rowcount
+                    self.con.commit()
+                    self.invalidate(t_name)
+                    if t_name == "trophies":
+                        self.invalidate("trophies_hourly")
+                    # Jump straight over gaps in the history
+                    self.cursor.execute(f"SELECT min(Date) FROM {t_name} WHERE Date >= ? AND Date < ?",
+                                        (end, t_cutoff))
+                    oldest = self.cursor.fetchone()[0]
+            except sqlite3.Error as e:
+                print(e)
+                self.con.rollback()
+                logger.error("Failed to apply retention to %s!", t_name)
+                return results
+
+        try:
+            self.cursor.execute("PRAGMA auto_vacuum")
+            if self.cursor.fetchone()[0] == 2:
+                self.cursor.execute(f"PRAGMA incremental_vacuum({int(vacuum_pages)})")
+                self.cursor.fetchall()
+        except sqlite3.Error as e:
+            print(e)
+            logger.error("Failed to reclaim free pages after retention!")
+            return results
+        logger.info("Retention applied: %s", results)
+        return results
+
+    def create_dimensions(self) -> bool:
+        """ Creates the clans, players and player_names dimension tables
+
+        Event tables store the integer ClanId/PlayerId instead of repeating tags and
+        names on every row; clan_id() and player_id() translate tags through an
+        in-process cache so the hot path rarely touches these tables.
+
+        Returns:
+            bool: Success
+        """
+        return (self.create_table("clans", CLANS_TABLE)
+                and self.create_table("players", PLAYERS_TABLE)
+                and self.create_table("player_names", PLAYER_NAMES_TABLE, indexes=[("PlayerId", "Date")]))
+
+    def clan_id(self, tag: str) -> int:
+        """ Returns the surrogate key for a clan tag, adding the clan if it is new
+
+        Args:
+            tag (str): clan tag
+
+        Returns:
+            int: ClanId, or None on failure
+        """
+        cached = self._clan_ids.get(tag)
+        if cached is not None:
+            return cached
+
+        self._auto_reconnect()
+        try:
+            self.cursor.execute("SELECT ClanId FROM clans WHERE Tag = ?", (tag,))
+            found = self.cursor.fetchone()
+            if found is None:
+                self.cursor.execute("INSERT INTO clans (Tag) VALUES (?)", (tag,))
+                found = (self.cursor.lastrowid,)
+                self.con.commit()
+                self.invalidate("clans")
+        except sqlite3.Error as e:
+            print(e)
+            self.con.rollback()
+            logger.error("Failed to look up clan %s!", tag)
+            return None
+        self._clan_ids[tag] = found[0]
+        return found[0]
+
+    def player_id(self, tag: str, name: str = None) -> int:
+        """ Returns the surrogate key for a player tag, adding the player if it is new
+
+        If a different name is given than the one on record, the player's name is updated
+        and the new name is added to player_names, so renames are tracked over time.
+
+        Args:
+            tag (str): player tag
+            name (str, optional): player's current name. Defaults to None (don't check).
+
+        Returns:
+            int: PlayerId, or None on failure
+        """
+        cached = self._players.get(tag)
+        if cached is not None and (name is None or cached[1] == name):
+            return cached[0]
+
+        self._auto_reconnect()
+        try:
+            if cached is None:
+                self.cursor.execute("SELECT PlayerId, Name FROM players WHERE Tag = ?", (tag,))
+                found = self.cursor.fetchone()
+                if found is None:
+                    self.cursor.execute("INSERT INTO players (Tag) VALUES (?)", (tag,))
+                    found = (self.cursor.lastrowid, None)
+                cached = list(found)
+            if name is not None and cached[1] != name:
+                self.cursor.execute("UPDATE players SET Name = ? WHERE PlayerId = ?", (name, cached[0]))
+                self.cursor.execute("INSERT INTO player_names (PlayerId, Name, Date) VALUES (?, ?, ?)",
+                                    (cached[0], name, to_epoch()))
+                cached[1] = name
+            self.con.commit()
+            self.invalidate("players")
+        except sqlite3.Error as e:
+            print(e)
+            self.con.rollback()
+            logger.error("Failed to look up player %s!", tag)
+            return None
+        self._players[tag] = cached
+        return cached[0]
+
+    def roster_members(self, clan_tag: str) -> list:
+        """ Player tags currently in a clan according to the roster table
+
+        Args:
+            clan_tag (str): clan tag
+
+        Returns:
+            list: player tags with no Left date, or None on failure
+        """
+        self._auto_reconnect()
+        try:
+            self.cursor.execute("SELECT COC FROM roster WHERE Clan = ? AND Left IS NULL", (clan_tag,))
+            return [row[0] for row in self.cursor.fetchall()]
+        except sqlite3.Error as e:
+            print(e)
+            logger.error("Failed to read the roster of %s!", clan_tag)
+            return None
+
+    def roster_update(self, clan_tag: str, joined=(), left=(), when: int = None) -> bool:
+        """ Records members joining and leaving a clan, in one transaction
+
+        The roster keeps one row per player (unique on COC), so a joiner's row is moved to
+        the new clan while its Discord link is kept. A leave only closes the row if the
+        player is still on record in this clan, so a move between two monitored clans is
+        not undone when the old clan reports the leave after the new one reports the join.
+
+        Args:
+            clan_tag (str): clan tag
+            joined (Iterable[str], optional): player tags that joined. Defaults to ().
+            left (Iterable[str], optional): player tags that left. Defaults to ().
+            when (int, optional): epoch seconds of the change. Defaults to None (now).
+
+        Returns:
+            bool: True on success
+        """
+        when = to_epoch() if when is None else when
+        self._auto_reconnect()
+        try:
+            self.cursor.executemany(
+                "INSERT INTO roster (COC, Clan, Joined, Left) VALUES (?, ?, ?, NULL) "
+                "ON CONFLICT (COC) DO UPDATE SET Clan = excluded.Clan, Joined = excluded.Joined, Left = NULL",
+                [(tag, clan_tag, when) for tag in joined])
+            self.cursor.executemany("UPDATE roster SET Left = ? WHERE COC = ? AND Clan = ? AND Left IS NULL",
+                                    [(when, tag, clan_tag) for tag in left])
+            self.con.commit()
+        except sqlite3.Error as e:
+            print(e)
+            self.con.rollback()
+            logger.error("Failed to update the roster of %s!", clan_tag)
+            return False
+        self.invalidate("roster")
+        return True
+
+    def create_named_views(self) -> bool:
+        """ Creates the *_named views that show the normalized event tables with tags and names
+
+        Handy for reports and exports; filtering by tag is faster on the base tables, where
+        get_df() matches the integer id. The views are dropped and recreated in one
+        transaction, so existing files pick up changed definitions.
+
+        Returns:
+            bool: Success
+        """
+        self._auto_reconnect()
+        try:
+            self.cursor.execute("BEGIN")
+            for v_name, sql in NAMED_VIEWS.items():
+                self.cursor.execute(f"DROP VIEW IF EXISTS {v_name}")
+                self.cursor.execute(f"CREATE VIEW {v_name} AS {sql}")
+            self.con.commit()
+        except sqlite3.Error as e:
+            print(e)
+            self.con.rollback()
+            logger.error("Failed to create named views!")
+            return False
+        for v_name in NAMED_VIEWS:
+            self.forget_statements(v_name)
+        return True
+
+    def drop_named_views(self):
+        """ Drops the *_named views, which would otherwise block rebuilding their base tables """
+        self._auto_reconnect()
+        for v_name in NAMED_VIEWS:
+            self.cursor.execute(f"DROP VIEW IF EXISTS {v_name}")
+            self.forget_statements(v_name)
+        self.con.commit()
+
+    def normalize_table(self, t_name: str) -> bool:
+        """ One-shot conversion of a table's tag/name columns to integer surrogate keys
+
+        Tags are copied into the dimension tables (names, and the first time each name was
+        seen, into players/player_names) and the table is rebuilt in one transaction with
+        ClanId/PlayerId/DonorId/RecipientId in place of Clan/PlayerTag/DonorTag/RecipientTag
+        and without the name columns. Placeholder tags that don't start with '#' become NULL.
+        Indexes and triggers are not carried over, the create_table()/create_rollups() calls
+        that follow recreate them for the new columns. Tables without tag columns are skipped,
+        so this is cheap to call on every startup.
+
+        Args:
+            t_name (str): table to normalize
+
+        Returns:
+            bool: Success (True if nothing needed normalizing)
+        """
+        self._auto_reconnect()
+        self.cursor.execute(f"PRAGMA table_info({t_name})")
+        info = self.cursor.fetchall()
+        names = [col[1] for col in info]
+        tag_cols = [c for c in names if c in NORMALIZED_COLUMNS]
+        if not tag_cols:
+            return True
+        if not self.create_dimensions():
+            return False
+        self.drop_named_views()
+
+        name_cols = [NORMALIZED_COLUMNS[c][2] for c in tag_cols]
+        order = "ORDER BY Date" if "Date" in names else ""
+        t_cols = []
+        new_cols = []
+        select = []
+        for _, name, ctype, notnull, dflt, _ in info:
+            if name in name_cols:
+                continue
+            constraint = ("NOT NULL " if notnull else "") + (f"DEFAULT {dflt}" if dflt is not None else "")
+            if name in NORMALIZED_COLUMNS:
+                id_col, dim, _ = NORMALIZED_COLUMNS[name]
+                key = "ClanId" if dim == "clans" else "PlayerId"
+                t_cols.append(f"{id_col} integer {constraint}")
+                new_cols.append(id_col)
+                select.append(f"(SELECT {key} FROM {dim} WHERE Tag = {t_name}.{name})")
+            else:
+                t_cols.append(f'"{name}" {ctype} {constraint}')
+                new_cols.append(f'"{name}"')
+                select.append(f'"{name}"')
+        pk = [col[1] for col in sorted(info, key=lambda col: col[5]) if col[5]]
+        pk = [NORMALIZED_COLUMNS[c][0] if c in NORMALIZED_COLUMNS else c for c in pk]
+        if pk:
+            t_cols.append(f"PRIMARY KEY ({', '.join(pk)})")
+
+        try:
+            self.cursor.execute("BEGIN")
+            for tag_col in tag_cols:
+                _, dim, name_col = NORMALIZED_COLUMNS[tag_col]
+                if dim == "clans":
+                    self.cursor.execute(f"""INSERT INTO clans (Tag) SELECT DISTINCT {tag_col} FROM {t_name}
+                                            WHERE {tag_col} LIKE '#%' ON CONFLICT (Tag) DO NOTHING""")
+                    continue
+                name_expr = name_col if name_col in names else "NULL"
+                # Rows are visited in Date order so the latest name wins
+                self.cursor.execute(f"""INSERT INTO players (Tag, Name) SELECT {tag_col}, {name_expr} FROM {t_name}
+                                        WHERE {tag_col} LIKE '#%' {order}
+                                        ON CONFLICT (Tag) DO UPDATE SET Name = coalesce(excluded.Name, Name)""")
+                if name_col in names and "Date" in names:
+                    self.cursor.execute(f"""INSERT INTO player_names (PlayerId, Name, Date)
+                                            SELECT p.PlayerId, t.{name_col}, min(t.Date)
+                                            FROM {t_name} t JOIN players p ON p.Tag = t.{tag_col}
+                                            WHERE t.{name_col} IS NOT NULL AND NOT EXISTS (
+                                                SELECT 1 FROM player_names n
+                                                WHERE n.PlayerId = p.PlayerId AND n.Name = t.{name_col})
+                                            GROUP BY p.PlayerId, t.{name_col}""")
+                    # Several tables may be normalized, the most recently seen name wins overall
+                    self.cursor.execute("""UPDATE players SET Name = (
+                                               SELECT n.Name FROM player_names n WHERE n.PlayerId = players.PlayerId
+                                               ORDER BY n.Date DESC LIMIT 1)
+                                           WHERE PlayerId IN (SELECT PlayerId FROM player_names)""")
+            self.cursor.execute(f"CREATE TABLE {t_name}_normalized ({', '.join(t_cols)})")
+            self.cursor.execute(f"""INSERT INTO {t_name}_normalized ({', '.join(new_cols)})
+                                    SELECT {', '.join(select)} FROM {t_name}""")
+            self.cursor.execute(f"DROP TABLE {t_name}")
+            self.cursor.execute(f"ALTER TABLE {t_name}_normalized RENAME TO {t_name}")
+            self.con.commit()
+            self.forget_statements()
+            logger.info("Normalized %s to integer keys", t_name)
+            return True
+        except sqlite3.Error as e:
+            print(e)
+            self.con.rollback()
+            self.forget_statements()
+            logger.error("Failed to normalize %s!", t_name)
+            return False
+
+    def migrate_epoch_dates(self, t_name: str, date_col: str = "Date") -> bool:
+        """ One-shot conversion of a text date column to integer epoch seconds (UTC)
+
+        Old rows were written with datetime.now() formatted as DATE_FORMAT, i.e. local time,
+        so they are converted with sqlite's 'utc' modifier. SQLite can't change a column's
+        type in place, so the table is rebuilt (with its indexes) inside one transaction.
+        Tables whose column is already declared integer are skipped, so this is cheap to
+        call on every startup.
+
+        Args:
+            t_name (str): table to migrate
+            date_col (str, optional): column holding the timestamp. Defaults to "Date".
+
+        Returns:
+            bool: Success (True if nothing needed migrating)
+        """
+        self._auto_reconnect()
+        self.cursor.execute(f"PRAGMA table_info({t_name})")
+        types = {info[1]: info[2].upper() for info in self.cursor.fetchall()}
+        if not types:
+            return True
+        if date_col not in types:
+            logger.error("Table %s has no %s column to migrate!", t_name, date_col)
+            return False
+        if types[date_col] in ("INT", "INTEGER"):
+            return True
+        self.drop_named_views()
+
+        self.cursor.execute("SELECT type, sql FROM sqlite_master WHERE tbl_name = ? AND sql IS NOT NULL", (t_name,))
+        schema = self.cursor.fetchall()
+        table_sql = [sql for kind, sql in schema if kind == "table"][0]
+        # Indexes and triggers (e.g. rollups) are dropped with the old table, so recreate them
+        index_sql = [sql for kind, sql in schema if kind in ("index", "trigger")]
+
+        new_sql = re.sub(rf"(\b{date_col}\s+)\w+", r"\1integer", table_sql, count=1)
+        new_sql = new_sql.replace(t_name, f"{t_name}_epoch", 1)
+        cols = ", ".join(f'"{c}"' for c in types)
+        converted = ", ".join(
+            f"CAST(strftime('%s', \"{c}\", 'utc') AS INTEGER)" if c == date_col else f'"{c}"'
+            for c in types
+        )
+
+        try:
+            self.cursor.execute("BEGIN")
+            self.cursor.execute(new_sql)
+            self.cursor.execute(f"INSERT INTO {t_name}_epoch ({cols}) SELECT {converted} FROM {t_name}")
+            self.cursor.execute(f"DROP TABLE {t_name}")
+            self.cursor.execute(f"ALTER TABLE {t_name}_epoch RENAME TO {t_name}")
+            for sql in index_sql:
+                self.cursor.execute(sql)
+            self.con.commit()
+            self.forget_statements(t_name)
+            logger.info("Migrated %s.%s to epoch seconds", t_name, date_col)
+            return True
+        except sqlite3.Error as e:
+            print(e)
+            self.con.rollback()
+            logger.error("Failed to migrate %s.%s to epoch seconds!", t_name, date_col)
+            return False
+
+    def schema_version(self) -> int:
+        """ Returns the newest migration version recorded in schema_migrations
+
+        Returns:
+            int: schema version, 0 for a database that predates the migrations
+        """
+        self._auto_reconnect()
+        self.cursor.execute(f"CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE}")
+        self.cursor.execute("SELECT max(Version) FROM schema_migrations")
+        return self.cursor.fetchone()[0] or 0
+
+    def migrate(self, migrations: list) -> bool:
+        """ Applies the migrations newer than the database's schema version, in order
+
+        Each applied version is recorded in schema_migrations with the time it ran, so once
+        a file is up to date this is one query. A version made only of SQL strings runs
+        in a single transaction together with its version row. Callable steps (the
+        migrate/normalize/create helpers) commit on their own and are safe to re-run, so a
+        version that fails halfway is simply retried on the next startup. Migration stops
+        at the first failing version.
+
+        Example:
+            from schema import MIGRATIONS
+            db.migrate(MIGRATIONS)
+
+        Args:
+            migrations (list): (version, description, steps) tuples, see schema.MIGRATIONS
+
+        Returns:
+            bool: Success (True if nothing needed migrating)
+        """
+        current = self.schema_version()
+        latest = max((version for version, _, _ in migrations), default=0)
+        if current > latest:
+            logger.warning("Database schema version %d is newer than this code (%d)!", current, latest)
+            return True
+
+        for version, description, steps in sorted(migrations, key=lambda migration: migration[0]):
+            if version <= current:
+                continue
+            try:
+                if all(isinstance(step, str) for step in steps):
+                    self.cursor.execute("BEGIN")
+                for step in steps:
+                    if isinstance(step, str):
+                        self.cursor.execute(step)
+                    elif step(self) is False:
+                        raise sqlite3.OperationalError(f"step {steps.index(step) + 1} failed")
+                self.cursor.execute("INSERT INTO schema_migrations (Version, Name, Date) VALUES (?, ?, ?)",
+                                    (version, description, to_epoch()))
+                self.con.commit()
+            except sqlite3.Error as e:
+                print(e)
+                self.con.rollback()
+                logger.error("Failed schema migration %d (%s)!", version, description)
+                return False
+            finally:
+                # Steps may have reshaped any table
+                self.forget_statements()
+            logger.info("Applied schema migration %d: %s", version, description)
+        return True
+
+    def custom_sql_command(self, cmd: str):
+        """ This is a custom function for me to test new sql functions
+
+        Args:
+            cmd (str): pre-formatted SQL string command
+
+        Returns:
+            bool: Success or failure
+        """
+        self._auto_reconnect()
+        try:
+            self.cursor.execute(cmd)
+            self.con.commit()
+            # The command may have altered any table, so rebuild statements lazily
+            self.forget_statements()
+            return True
+        except sqlite3.Error as e:
+            print(e)
+            logger.error("Custom SQL command failed!")
+            return False
+
+    def close(self):
+        """ Close the connection (Usually not needed)
+            Database must call create_connection again to be usable, unless it is persistent,
+            in which case the next operation will reopen it.
+            Any rows still in the write buffer are flushed first.
+        """
+        if self._pending_count:
+            self.flush()
+        self.close_readers()
+        if not self.is_connected():
+            return
+        self.cursor.close()
+        self.con.close()
+
+
+class DatabaseWriter():
+    """ Background thread that owns the sqlite connection used for event ingestion
+
+    Async event handlers call submit(), which only puts the row on a bounded queue and
+    returns immediately, so the asyncio loop never waits on sqlite. The writer thread
+    drains the queue into a buffered, persistent Database and commits in batches.
+
+    If the queue is full the row is dropped and counted instead of blocking the caller;
+    stats() reports the queue depth, high water mark and drop count so backpressure is
+    visible in the logs.
+    """
+    def __init__(self, db_name: str = "my_database.db", db_path: str = "./", max_queue: int = 10000,
+                 batch_rows: int = 200, batch_ms: int = 1000, profile: dict = None, items=None) -> None:
+        """ Constructor for the writer, call start() to launch the thread
+
+        Passing items lets other processes feed the writer: they put the same
+        (t_name, row, headers) / (None, record, None) tuples submit() would on a shared
+        multiprocessing.Queue, see supervisor.py.
+
+        Args:
+            db_name (str, optional): filename of the database. Defaults to "my_database.db".
+            db_path (str, optional): directory of the database. Defaults to "./".
+            max_queue (int, optional): rows allowed to wait before submit() drops. Defaults to 10000.
+            batch_rows (int, optional): commit after this many rows. Defaults to 200.
+            batch_ms (int, optional): commit once the oldest row is this old. Defaults to 1000.
+            profile (dict, optional): pragmas for the writer's connection. Defaults to None.
+            items (queue-like, optional): queue to drain instead of a private one of max_queue.
+                                            Defaults to None.
+        """
+        self.db_name = db_name
+        self.db_path = db_path
+        self.batch_rows = batch_rows
+        self.batch_ms = batch_ms
+        self.profile = profile
+        self.queue = queue.Queue(maxsize=max_queue) if items is None else items
+        self.thread = None
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.high_water = 0
+
+    def start(self):
+        """ Launches the writer thread (no-op if it is already running) """
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._run, name="DatabaseWriter", daemon=True)
+        self.thread.start()
+        logger.info("Database writer started")
+
+    def submit(self, t_name: str, row, headers="") -> bool:
+        """ Queues a row for the writer thread without blocking
+
+        Args:
+            t_name (str): Name of the table to be modified
+            row (tuple): Row to be appended to the table
+            headers (str | list, optional): columns the row fills. Defaults to all columns.
+
+        Returns:
+            bool: False if the queue was full and the row was dropped
+        """
+        return self._enqueue((t_name, tuple(row), headers), t_name)
+
+    def submit_record(self, record) -> bool:
+        """ Queues a record from records.py, which knows its own table
+
+        Records are resolved to integer keys on the writer thread, which owns the id cache.
+
+        Args:
+            record (NamedTuple): record with a TABLE attribute and a resolve(db) or write(db) method
+
+        Returns:
+            bool: False if the queue was full and the record was dropped
+        """
+        return self._enqueue((None, record, None), record.TABLE)
+
+    def _enqueue(self, item: tuple, t_name: str) -> bool:
+        """ put_nowait with drop counting, shared by submit() and submit_record() """
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            # Only log the start of a burst and then periodically, so the log doesn't add to the storm
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                logger.warning("Database writer queue full, dropped row for %s (%d dropped)", t_name, self.dropped)
+            return False
+        self.submitted += 1
+        self.high_water = max(self.high_water, self.queue.qsize())
+        return True
+
+    def stats(self) -> dict:
+        """ Snapshot of the writer's throughput and backpressure counters
+
+        Returns:
+            dict: submitted, written, failed, dropped, queued and high_water counts
+        """
+        return {
+            "submitted": self.submitted,
+            "written": self.written,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "queued": self.queue.qsize(),
+            "high_water": self.high_water
+        }
+
+    def stop(self, timeout: float = None):
+        """ Drains everything already queued, commits it and stops the thread
+
+        Args:
+            timeout (float, optional): seconds to wait for the drain. Defaults to None (forever).
+        """
+        if self.thread is None or not self.thread.is_alive():
+            return
+        self.queue.put(None)
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            logger.error("Database writer did not drain within %s seconds!", timeout)
+        else:
+            logger.info("Database writer stopped: %s", self.stats())
+
+    def _run(self):
+        """ Writer thread body, the Database must be created here since sqlite objects are thread-bound """
+        db = Database(self.db_name, self.db_path, persistent=True,
+                      buffer_rows=self.batch_rows, buffer_ms=self.batch_ms, profile=self.profile)
+        pending = 0
+        wait = max(self.batch_ms, 1) / 1000
+
+        while True:
+            try:
+                item = self.queue.get(timeout=wait)
+            except queue.Empty:
+                item = ()
+
+            if item is None:
+                break
+            ok = True
+            if item:
+                t_name, row, headers = item
+                if t_name is None:
+                    ok = db.buffer_record(row)
+                else:
+                    ok = db.buffer_row(t_name, row=row, headers=headers)
+                pending += 1
+            if ok and db._pending_count:
+                ok = db.flush_if_due()
+
+            # The buffer only empties when a flush happened, count that batch
+            if pending and not db._pending_count:
+                if ok:
+                    self.written += pending
+                else:
+                    self.failed += pending
+                pending = 0
+
+        ok = db.flush()
+        if pending:
+            if ok:
+                self.written += pending
+            else:
+                self.failed += pending
+        db.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+    PARSER = argparse.ArgumentParser(description="Bulk import CSV/Parquet/Feather history into a table")
+    PARSER.add_argument("database", help="path of the .db file")
+    PARSER.add_argument("table", help="existing table to import into, e.g. trophies")
+    PARSER.add_argument("files", nargs="+", help="history files (.csv, .csv.gz, .parquet, .feather)")
+    PARSER.add_argument("--chunksize", type=int, default=100000)
+    PARSER.add_argument("--date-format", default=None, help="strptime format of text dates, e.g. %%Y-%%m-%%d_%%Hh")
+    ARGS = PARSER.parse_args()
+
+    DB = Database(db_name=os.path.basename(ARGS.database), db_path=os.path.dirname(ARGS.database) or ".",
+                  persistent=True, profile=PERFORMANCE_PROFILE)
+    for FILE in ARGS.files:
+        if DB.bulk_import(ARGS.table, FILE, chunksize=ARGS.chunksize, date_format=ARGS.date_format,
+                          progress=lambda n: print(f"\r{n} rows", end="", flush=True)) < 0:
+            sys.exit(1)
+        print()
+    DB.optimize()
+    DB.close()
@@ -0,0 +1,165 @@
+""" @file recorder.py
+    @author Sean Duffie
+    @brief Turns clan events into database records
+
+    Shared by clashbot.py and the supervisor shards so both record events the same way.
+    EventRecorder builds the records for each member event, hands them to a submit
+    callable (DatabaseWriter.submit_record, or a shard's queue), feeds the trophy
+    coalescer and keeps the poll scheduler's player set in step with the roster.
+    The coc decorated handlers stay in the entry points and only call into it.
+"""
+import logging
+from typing import Callable, List
+
+import coc
+
+from database import to_epoch
+from records import DonationRecord, RosterRecord, TrophyCoalescer, TrophyRecord
+from scheduler import PollScheduler
+
+logger = logging.getLogger("Clash")
+
+
+class EventRecorder():
+    """ Builds and submits the records for clan member events """
+    def __init__(self, submit: Callable, window: int = 60, scheduler: PollScheduler = None) -> None:
+        """ Constructor for the recorder
+
+        Args:
+            submit (Callable): called with every finished record, returns False if it was dropped
+            window (int, optional): trophy coalescing window in seconds. Defaults to 60.
+            scheduler (PollScheduler, optional): player polling to keep up to date.
+                                                    Defaults to None (a new one).
+        """
+        self.submit = submit
+        self.coalescer = TrophyCoalescer(window=window)
+        self.scheduler = PollScheduler() if scheduler is None else scheduler
+
+    def donated(self, old_member, new_member) -> DonationRecord:
+        """ A member donated troops
+
+        Args:
+            old_member (coc.ClanMember): member before the update
+            new_member (coc.ClanMember): member after the update
+
+        Returns:
+            DonationRecord: the submitted record
+        """
+        record = DonationRecord.donated(new_member, new_member.donations - old_member.donations)
+        self.submit(record)
+        self.scheduler.record_activity(new_member.tag)
+        return record
+
+    def received(self, old_member, new_member) -> DonationRecord:
+        """ A member received troops
+
+        Args:
+            old_member (coc.ClanMember): member before the update
+            new_member (coc.ClanMember): member after the update
+
+        Returns:
+            DonationRecord: the submitted record
+        """
+        record = DonationRecord.received(new_member, new_member.received - old_member.received)
+        self.submit(record)
+        self.scheduler.record_activity(new_member.tag)
+        return record
+
+    def trophies(self, old_member, new_member) -> List[TrophyRecord]:
+        """ A member's trophy count changed, the change is held until its burst ends
+
+        Args:
+            old_member (coc.ClanMember): member before the update
+            new_member (coc.ClanMember): member after the update
+
+        Returns:
+            List[TrophyRecord]: bursts that finished and were submitted
+        """
+        self.scheduler.record_activity(new_member.tag)
+        return self._submit_bursts(self.coalescer.add(TrophyRecord.from_member(new_member, old_member.trophies)))
+
+    def flush_due(self) -> List[TrophyRecord]:
+        """ Submits the trophy bursts whose window has closed, call every few seconds
+
+        Returns:
+            List[TrophyRecord]: bursts submitted
+        """
+        return self._submit_bursts(self.coalescer.pop_due())
+
+    def flush_all(self) -> List[TrophyRecord]:
+        """ Submits every open trophy burst, call at shutdown
+
+        Returns:
+            List[TrophyRecord]: bursts submitted
+        """
+        return self._submit_bursts(self.coalescer.pop_all())
+
+    def joined(self, member, clan) -> RosterRecord:
+        """ A member joined, add them to the roster and poll them right away
+
+        Args:
+            member (coc.ClanMember): member that joined
+            clan (coc.Clan): clan joined
+
+        Returns:
+            RosterRecord: the submitted record
+        """
+        record = RosterRecord.join(member, clan)
+        self.submit(record)
+        self.scheduler.track(member.tag)
+        self.scheduler.record_activity(member.tag)
+        return record
+
+    def left(self, member, clan) -> RosterRecord:
+        """ A member left, close their roster row and stop polling them
+
+        Args:
+            member (coc.ClanMember): member that left
+            clan (coc.Clan): clan left
+
+        Returns:
+            RosterRecord: the submitted record
+        """
+        record = RosterRecord.leave(member, clan)
+        self.submit(record)
+        self.scheduler.untrack(member.tag)
+        return record
+
+    async def follow(self, coc_client, clan_tags: List[str], stored: Callable):
+        """ Starts following the clans' members, catching up on the roster first
+
+        Each clan is fetched once. Members that joined or left while nothing was
+        listening are submitted as one RosterRecord per clan, so the roster table is
+        only written by the writer, and every current member is handed to the scheduler.
+        If a clan can't be fetched, its stored roster is followed instead.
+
+        Args:
+            coc_client (coc.EventsClient): logged in client
+            clan_tags (List[str]): clans being monitored
+            stored (Callable): clan tag -> player tags on its stored roster (None on failure),
+                                e.g. Database.roster_members
+        """
+        for clan_tag in clan_tags:
+            known = stored(clan_tag) or []
+            try:
+                clan = await coc_client.get_clan(clan_tag)
+            except coc.HTTPException as error:
+                logger.warning("Couldn't load %s (%s), following its stored roster", clan_tag, error)
+                self.scheduler.track(*known)
+                continue
+            members = [member.tag for member in clan.members]
+            joined = tuple(sorted(set(members).difference(known)))
+            left = tuple(sorted(set(known).difference(members)))
+            if joined or left:
+                self.submit(RosterRecord(to_epoch(), clan.tag, joined, left))
+                logger.info("%s roster: %d joined, %d left since the last run", clan.name, len(joined), len(left))
+            self.scheduler.track(*members)
+        self.scheduler.apply(coc_client)
+
+    def _submit_bursts(self, records: List[TrophyRecord]) -> List[TrophyRecord]:
+        """ Submits finished trophy bursts, one log line per burst """
+        for record in records:
+            self.submit(record)
+            logger.info("%s trophies changed from %d to %d (%d changes, min %d, max %d)", record.PlayerName,
+                        record.TrophyFirst, record.Trophies, record.Changes, record.TrophyMin, record.TrophyMax)
+        return records
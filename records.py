@@ -0,0 +1,277 @@
+""" @file records.py
+    @author Sean Duffie
+    @brief Lightweight event records written to the database
+
+    Each record is a NamedTuple holding the tags and names reported by the API, so it can be
+    built in an event handler without building a DataFrame or touching the database.
+    Database.buffer_record() (or DatabaseWriter.submit_record()) calls resolve() to swap
+    the tags for the integer ClanId/PlayerId keys the tables actually store.
+
+    Records that aren't a single insert, like RosterRecord, instead define write(db),
+    which the writer calls in queue order.
+
+    TrophyCoalescer merges bursts of trophy changes into one record per player per window
+    before they are written.
+"""
+from typing import TYPE_CHECKING, NamedTuple, Optional, Tuple
+
+from database import to_epoch
+
+if TYPE_CHECKING:
+    # Only needed for annotations, so the records can be built without the API client
+    import coc
+
+    from database import Database
+
+
+class TrophyRecord(NamedTuple):
+    """ One trophy change, or a burst of them merged by TrophyCoalescer
+
+    Date is when the burst started and Trophies the count after its last change, at
+    LastDate. TrophyFirst is the count before the burst, TrophyMin/TrophyMax include it,
+    and Changes counts the changes merged, a single change is a burst of one.
+    """
+    Date: int
+    Clan: str
+    PlayerTag: str
+    PlayerName: str
+    Trophies: int
+    LastDate: int
+    TrophyFirst: int
+    TrophyMin: int
+    TrophyMax: int
+    Changes: int
+
+    TABLE = "trophies"
+    COLUMNS = ("Date", "ClanId", "PlayerId", "Trophies", "LastDate", "TrophyFirst", "TrophyMin", "TrophyMax",
+               "Changes")
+    # Replays hit the (player, bucket, value) natural key and are skipped
+    ON_CONFLICT = "ignore"
+
+    @classmethod
+    def from_member(cls, member: "coc.ClanMember", previous: int = None) -> "TrophyRecord":
+        """ Snapshot a member's trophy change
+
+        Args:
+            member (coc.ClanMember): member after the trophy change
+            previous (int, optional): trophy count before the change. Defaults to None (unknown,
+                                        the current count is used).
+
+        Returns:
+            TrophyRecord: row timestamped now
+        """
+        now = to_epoch()
+        trophies = member.trophies
+        first = trophies if previous is None else previous
+        return cls(now, member.clan.tag, member.tag, member.name, trophies, now, first, min(first, trophies),
+                   max(first, trophies), 1)
+
+    def merge(self, later: "TrophyRecord") -> "TrophyRecord":
+        """ Combines this burst with a later change (or burst) of the same player
+
+        Args:
+            later (TrophyRecord): the newer record
+
+        Returns:
+            TrophyRecord: one record starting at this one and ending at the later one
+        """
+        return later._replace(
+            Date=self.Date,
+            TrophyFirst=self.TrophyFirst,
+            TrophyMin=min(self.TrophyMin, later.TrophyMin),
+            TrophyMax=max(self.TrophyMax, later.TrophyMax),
+            Changes=self.Changes + later.Changes
+        )
+
+    def resolve(self, db: "Database") -> tuple:
+        """ Translates the tags to the row stored in the trophies table
+
+        Args:
+            db (Database): database whose id cache is used
+
+        Returns:
+            tuple: the values of COLUMNS, or None if a lookup failed
+        """
+        clan_id = db.clan_id(self.Clan)
+        player_id = db.player_id(self.PlayerTag, self.PlayerName)
+        if clan_id is None or player_id is None:
+            return None
+        return (self.Date, clan_id, player_id, self.Trophies, self.LastDate, self.TrophyFirst, self.TrophyMin,
+                self.TrophyMax, self.Changes)
+
+
+class DonationRecord(NamedTuple):
+    """ One donation, stored as (Date, ClanId, DonorId, RecipientId, Amount, Total)
+
+    The API only reports per-member totals, so the other side of a donation is unknown
+    and left as None (NULL in the table). Total is that season total after the donation.
+    It only grows during a season, so it tells a reported-again donation (same Total)
+    apart from a new one of the same amount.
+    """
+    Date: int
+    Clan: str
+    DonorTag: Optional[str]
+    DonorName: Optional[str]
+    RecipientTag: Optional[str]
+    RecipientName: Optional[str]
+    Amount: int
+    Total: Optional[int]
+
+    TABLE = "donations"
+    COLUMNS = ("Date", "ClanId", "DonorId", "RecipientId", "Amount", "Total")
+    ON_CONFLICT = "ignore"
+
+    @classmethod
+    def donated(cls, member: "coc.ClanMember", amount: int) -> "DonationRecord":
+        """ Troops donated by a member
+
+        Args:
+            member (coc.ClanMember): member that donated
+            amount (int): troops donated since the last update
+
+        Returns:
+            DonationRecord: row timestamped now
+        """
+        return cls(to_epoch(), member.clan.tag, member.tag, member.name, None, None, amount, member.donations)
+
+    @classmethod
+    def received(cls, member: "coc.ClanMember", amount: int) -> "DonationRecord":
+        """ Troops received by a member
+
+        Args:
+            member (coc.ClanMember): member that received
+            amount (int): troops received since the last update
+
+        Returns:
+            DonationRecord: row timestamped now
+        """
+        return cls(to_epoch(), member.clan.tag, None, None, member.tag, member.name, amount, member.received)
+
+    def resolve(self, db: "Database") -> tuple:
+        """ Translates the tags to the row stored in the donations table
+
+        Args:
+            db (Database): database whose id cache is used
+
+        Returns:
+            tuple: the values of COLUMNS, or None if a lookup failed
+        """
+        clan_id = db.clan_id(self.Clan)
+        donor_id = None if self.DonorTag is None else db.player_id(self.DonorTag, self.DonorName)
+        recipient_id = None if self.RecipientTag is None else db.player_id(self.RecipientTag, self.RecipientName)
+        if clan_id is None or (self.DonorTag is not None and donor_id is None) \
+                or (self.RecipientTag is not None and recipient_id is None):
+            return None
+        return (self.Date, clan_id, donor_id, recipient_id, self.Amount, self.Total)
+
+
+class RosterRecord(NamedTuple):
+    """ Members that joined or left a clan, applied with Database.roster_update() """
+    Date: int
+    Clan: str
+    Joined: Tuple[str, ...]
+    Left: Tuple[str, ...]
+
+    TABLE = "roster"
+
+    @classmethod
+    def join(cls, member: "coc.ClanMember", clan: "coc.Clan") -> "RosterRecord":
+        """ A member joining a clan
+
+        Args:
+            member (coc.ClanMember): member that joined
+            clan (coc.Clan): clan joined
+
+        Returns:
+            RosterRecord: change timestamped now
+        """
+        return cls(to_epoch(), clan.tag, (member.tag,), ())
+
+    @classmethod
+    def leave(cls, member: "coc.ClanMember", clan: "coc.Clan") -> "RosterRecord":
+        """ A member leaving a clan
+
+        Args:
+            member (coc.ClanMember): member that left
+            clan (coc.Clan): clan left
+
+        Returns:
+            RosterRecord: change timestamped now
+        """
+        return cls(to_epoch(), clan.tag, (), (member.tag,))
+
+    def write(self, db: "Database") -> bool:
+        """ Applies the change to the roster table
+
+        Args:
+            db (Database): the writer's database
+
+        Returns:
+            bool: Success
+        """
+        return db.roster_update(self.Clan, self.Joined, self.Left, self.Date)
+
+
+class TrophyCoalescer():
+    """ Merges successive trophy changes of a player into one record per window
+
+    During an active session a player can change trophies many times a minute. The first
+    change opens a window of `window` seconds, later changes inside it are merged into
+    the same TrophyRecord, and the record is handed back once the window has passed, so
+    one row is written per burst instead of one per change.
+
+    Everything runs on the event loop, so no locking is needed. Keep the window at least
+    DEDUP_BUCKET seconds, so two real bursts of a player never share a natural key.
+    """
+    def __init__(self, window: int = 60) -> None:
+        """ Constructor for the coalescer
+
+        Args:
+            window (int, optional): seconds a burst stays open after its first change. Defaults to 60.
+        """
+        self.window = window
+        self.received = 0
+        self.emitted = 0
+        self._open = {}
+
+    def add(self, record: TrophyRecord) -> list:
+        """ Merges a change into its player's open burst, or starts a new one
+
+        Args:
+            record (TrophyRecord): the new change
+
+        Returns:
+            list: the player's previous burst if its window had already passed, else empty
+        """
+        self.received += 1
+        current = self._open.get(record.PlayerTag)
+        if current is not None and record.LastDate - current.Date < self.window:
+            self._open[record.PlayerTag] = current.merge(record)
+            return []
+        self._open[record.PlayerTag] = record
+        if current is None:
+            return []
+        self.emitted += 1
+        return [current]
+
+    def pop_due(self, now: int = None) -> list:
+        """ Closes every burst whose window has passed
+
+        Args:
+            now (int, optional): epoch seconds. Defaults to None (now).
+
+        Returns:
+            list: finished TrophyRecords, oldest first
+        """
+        now = to_epoch() if now is None else now
+        due = [tag for tag, record in self._open.items() if now - record.Date >= self.window]
+        self.emitted += len(due)
+        return sorted((self._open.pop(tag) for tag in due), key=lambda record: record.Date)
+
+    def pop_all(self) -> list:
+        """ Closes every open burst, e.g. on shutdown
+
+        Returns:
+            list: finished TrophyRecords, oldest first
+        """
+        return self.pop_due(now=float("inf"))
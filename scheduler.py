@@ -0,0 +1,203 @@
+""" @file scheduler.py
+    @author Sean Duffie
+    @brief Adaptive polling tiers for player updates
+
+    coc.EventsClient polls every registered player as often as the API cache allows, so
+    idle members cost as much quota and diffing as active ones. PollScheduler decides
+    which players are registered at any moment:
+        hot  - a trophy/donation event within hot_after seconds, registered continuously
+        warm - an event within warm_after seconds, registered for one slot every warm_interval
+        cold - everyone else, registered for one slot every cold_interval
+    Around the start of a war, raid weekend or clan games every player is bumped one tier
+    hotter. A player that is unregistered keeps its cached state in the client, so the
+    next poll still diffs against it and no events are lost, they only arrive later.
+
+    Only player polling is scheduled. Member donations and trophies come from the clan
+    endpoint, which keeps polling at full speed.
+"""
+import calendar
+import datetime
+import logging
+import zlib
+
+from database import to_epoch
+
+logger = logging.getLogger("Clash")
+
+TIERS = ("hot", "warm", "cold")
+# Raid weekends start Fridays 07:00 UTC, epoch 0 was a Thursday
+RAID_OFFSET = 86400 + 7 * 3600
+WEEK = 604800
+
+
+class PollScheduler():
+    """ Keeps the EventsClient's player update set sized to how active each player is """
+    def __init__(self, hot_after: int = 900, warm_after: int = 21600, warm_interval: int = 600,
+                 cold_interval: int = 3600, slot: int = 120, boost_before: int = 3600,
+                 boost_after: int = 21600) -> None:
+        """ Constructor for the scheduler
+
+        Args:
+            hot_after (int, optional): seconds since the last event a player stays hot. Defaults to 900.
+            warm_after (int, optional): seconds since the last event a player stays warm. Defaults to 21600.
+            warm_interval (int, optional): seconds between polls of a warm player. Defaults to 600.
+            cold_interval (int, optional): seconds between polls of a cold player. Defaults to 3600.
+            slot (int, optional): seconds a warm/cold player stays registered per poll,
+                                    long enough for one pass of the player updater. Defaults to 120.
+            boost_before (int, optional): seconds before an event start that the boost begins. Defaults to 3600.
+            boost_after (int, optional): seconds after an event start that the boost lasts. Defaults to 21600.
+        """
+        self.hot_after = hot_after
+        self.warm_after = warm_after
+        self.intervals = {"warm": warm_interval, "cold": cold_interval}
+        self.slot = slot
+        self.boost_before = boost_before
+        self.boost_after = boost_after
+        self.subscribed = set()
+        self._last_seen = {}
+        self._next_poll = {}
+        self._slot_end = {}
+        self._events = []
+
+    def track(self, *tags: str):
+        """ Starts scheduling players, e.g. the members of a clan or a new member
+
+        First polls are spread over the cold interval so a large roster doesn't
+        register all at once.
+
+        Args:
+            *tags (str): player tags
+        """
+        now = to_epoch()
+        for tag in tags:
+            if tag not in self._next_poll:
+                self._next_poll[tag] = now + zlib.crc32(tag.encode()) % self.intervals["cold"]
+
+    def untrack(self, *tags: str):
+        """ Stops scheduling players, e.g. members that left. apply() unregisters them.
+
+        Args:
+            *tags (str): player tags
+        """
+        for tag in tags:
+            self._next_poll.pop(tag, None)
+            self._last_seen.pop(tag, None)
+            self._slot_end.pop(tag, None)
+
+    def record_activity(self, tag: str, when: int = None):
+        """ Notes a trophy/donation event of a player
+
+        Args:
+            tag (str): player tag
+            when (int, optional): epoch seconds of the event. Defaults to None (now).
+        """
+        self._last_seen[tag] = to_epoch() if when is None else when
+
+    def add_event(self, start: int):
+        """ Adds an event start to boost around, e.g. the battle day of a new war
+
+        Raid weekends and clan games follow a fixed calendar and don't need adding.
+
+        Args:
+            start (int): epoch seconds the event starts
+        """
+        self._events.append(start)
+
+    def boosted(self, now: int = None) -> bool:
+        """ Is now within the boost window of a war, raid weekend or clan games start?
+
+        Args:
+            now (int, optional): epoch seconds. Defaults to None (now).
+
+        Returns:
+            bool: every player is polled one tier hotter
+        """
+        now = to_epoch() if now is None else now
+        self._events = [start for start in self._events if now - start < self.boost_after]
+
+        today = datetime.datetime.fromtimestamp(now, datetime.timezone.utc)
+        starts = list(self._events)
+        since_raid = (now - RAID_OFFSET) % WEEK
+        starts += [now - since_raid, now - since_raid + WEEK]
+        # Clan games start on the 22nd at 08:00 UTC, check this month and the next
+        for month in (today.month, today.month % 12 + 1):
+            year = today.year + (1 if month < today.month else 0)
+            starts.append(calendar.timegm((year, month, 22, 8, 0, 0)))
+        return any(-self.boost_before <= now - start < self.boost_after for start in starts)
+
+    def tier(self, tag: str, now: int = None, boosted: bool = None) -> str:
+        """ Current polling tier of a player
+
+        Args:
+            tag (str): player tag
+            now (int, optional): epoch seconds. Defaults to None (now).
+            boosted (bool, optional): precomputed boosted(now). Defaults to None.
+
+        Returns:
+            str: "hot", "warm" or "cold"
+        """
+        now = to_epoch() if now is None else now
+        idle = now - self._last_seen.get(tag, 0)
+        level = 0 if idle < self.hot_after else 1 if idle < self.warm_after else 2
+        if boosted if boosted is not None else self.boosted(now):
+            level = max(level - 1, 0)
+        return TIERS[level]
+
+    def tick(self, now: int = None) -> tuple:
+        """ Works out which players should be registered right now
+
+        Args:
+            now (int, optional): epoch seconds. Defaults to None (now).
+
+        Returns:
+            tuple: (tags to register, tags to unregister)
+        """
+        now = to_epoch() if now is None else now
+        boosted = self.boosted(now)
+        wanted = set()
+        for tag, next_poll in self._next_poll.items():
+            tier = self.tier(tag, now, boosted)
+            if tier == "hot":
+                wanted.add(tag)
+                continue
+            if now >= next_poll:
+                self._slot_end[tag] = now + self.slot
+                self._next_poll[tag] = now + self.intervals[tier]
+            if now < self._slot_end.get(tag, 0):
+                wanted.add(tag)
+
+        add = wanted - self.subscribed
+        remove = self.subscribed - wanted
+        self.subscribed = wanted
+        return add, remove
+
+    def apply(self, coc_client, now: int = None):
+        """ Registers/unregisters players on the client according to tick()
+
+        Args:
+            coc_client (coc.EventsClient): client whose player updates are managed
+            now (int, optional): epoch seconds. Defaults to None (now).
+        """
+        add, remove = self.tick(now)
+        if add:
+            coc_client.add_player_updates(*add)
+        if remove:
+            coc_client.remove_player_updates(*remove)
+        if add or remove:
+            logger.debug("Player polling: +%d -%d, %d registered", len(add), len(remove), len(self.subscribed))
+
+    def stats(self, now: int = None) -> dict:
+        """ Tier sizes, for logging
+
+        Args:
+            now (int, optional): epoch seconds. Defaults to None (now).
+
+        Returns:
+            dict: players per tier, registered players and whether a boost is active
+        """
+        now = to_epoch() if now is None else now
+        boosted = self.boosted(now)
+        counts = dict.fromkeys(TIERS, 0)
+        for tag in self._next_poll:
+            counts[self.tier(tag, now, boosted)] += 1
+        return {**counts, "registered": len(self.subscribed), "boosted": boosted}
@@ -0,0 +1,129 @@
+""" @file schema.py
+    @author Sean Duffie
+    @brief Declared tables and the versioned migrations that build them
+
+    TABLES is the current shape of every event table, in create_table() keyword form.
+    "duplicates" says what to do with existing rows that break a new unique key (see
+    Database.create_index()).
+    MIGRATIONS is the ordered history of schema changes. Database.migrate() applies the
+    versions that a database file hasn't seen yet and records each one in the
+    schema_migrations table, so startup only does real work after an upgrade.
+
+    To change the schema, edit TABLES and append a new version. Don't edit or renumber
+    versions that have already shipped.
+"""
+from database import DEDUP_BUCKET, index_name
+
+# Natural keys that stopped being declared, dropped by a migration
+OLD_DONATIONS_KEY = ("coalesce(DonorId, 0)", "coalesce(RecipientId, 0)", f"Date / {DEDUP_BUCKET}", "Amount")
+
+TABLES = {
+    "roster": {
+        "cols": [
+            ("COC", "text", ""),
+            ("Discord", "text", ""),
+            # Current membership, kept up to date by the member join/leave events
+            ("Clan", "text", ""),
+            ("Joined", "integer", ""),
+            ("Left", "integer", "")
+        ],
+        "indexes": [
+            ("Clan", "Left")
+        ],
+        # One row per game account, see Database.roster_update(). Hand-entered rows are
+        # merged, and rows that disagree (two Discord links) stop the migration
+        "unique": [
+            ("COC",)
+        ],
+        "duplicates": "merge"
+    },
+    "trophies": {
+        "cols": [
+            ("Date", "integer", ""),
+            ("ClanId", "integer", ""),
+            ("PlayerId", "integer", ""),
+            ("Trophies", "int", ""),
+            # Summary of the burst of changes merged into this row (see records.TrophyCoalescer),
+            # Trophies is the value after the last change
+            ("LastDate", "integer", ""),
+            ("TrophyFirst", "int", ""),
+            ("TrophyMin", "int", ""),
+            ("TrophyMax", "int", ""),
+            ("Changes", "int", "DEFAULT 1")
+        ],
+        # Covering index for per-player trophy history, plus per-clan time scans
+        "indexes": [
+            ("PlayerId", "Date", "Trophies"),
+            ("ClanId", "Date"),
+            ("Date",)
+        ],
+        # Natural key: the same burst submitted or imported twice lands in the same bucket and is
+        # skipped. Date is when the bot saw the change and the API has no attack timestamp, so a
+        # change reported again after a restart or maintenance lands later and is kept
+        "unique": [
+            ("PlayerId", f"Date / {DEDUP_BUCKET}", "Trophies")
+        ],
+        # Duplicates are the same event recorded twice
+        "duplicates": "purge"
+    },
+    "donations": {
+        "cols": [
+            ("Date", "integer", ""),
+            ("ClanId", "integer", ""),
+            ("DonorId", "integer", ""),
+            ("RecipientId", "integer", ""),
+            ("Amount", "int", ""),
+            # Season total (donations or received) after the donation, see records.DonationRecord
+            ("Total", "int", "")
+        ],
+        "indexes": [
+            ("DonorId", "Date", "Amount"),
+            ("RecipientId", "Date", "Amount"),
+            ("ClanId", "Date"),
+            ("Date",)
+        ],
+        # Natural key: a donation reported again has the same season Total, a new one of the
+        # same amount doesn't. Totals restart each season, so they are only compared within a
+        # day. Imported rows without a Total only match on their exact Date
+        "unique": [
+            ("coalesce(DonorId, 0)", "coalesce(RecipientId, 0)", "Amount", "coalesce(Total, -1)",
+             "CASE WHEN Total IS NULL THEN Date ELSE Date / 86400 END")
+        ],
+        "duplicates": "purge"
+    }
+}
+
+# (version, description, steps). A step is either an SQL string or a callable taking the
+# Database and returning False on failure. The early versions wrap the conversions that
+# used to run ad hoc at every startup; each of them is a no-op on an already converted file.
+MIGRATIONS = [
+    (1, "Integer epoch dates", [
+        lambda db: db.migrate_epoch_dates("trophies"),
+        lambda db: db.migrate_epoch_dates("donations")
+    ]),
+    (2, "Player/clan dimension tables and integer keys", [
+        lambda db: db.create_dimensions(),
+        *[lambda db, t_name=t_name: db.normalize_table(t_name)
+          for t_name in ("trophies", "donations", "player_daily", "player_weekly", "trophies_hourly")]
+    ]),
+    (3, "Event tables, indexes and natural keys", [
+        lambda db: db.create_tables(TABLES)
+    ]),
+    (4, "Daily/weekly rollups and named views", [
+        lambda db: db.create_rollups(),
+        lambda db: db.create_named_views()
+    ]),
+    (5, "Coalesced trophy bursts", [
+        lambda db: db.create_tables(TABLES),
+        lambda db: db.create_rollups(),
+        lambda db: db.create_named_views()
+    ]),
+    (6, "Roster membership", [
+        lambda db: db.create_tables({"roster": TABLES["roster"]})
+    ]),
+    (7, "Donation key on season totals", [
+        f"DROP INDEX IF EXISTS {index_name('donations', OLD_DONATIONS_KEY, unique=True)}",
+        lambda db: db.create_tables({"donations": TABLES["donations"]}),
+        lambda db: db.create_named_views()
+    ])
+]
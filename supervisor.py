@@ -0,0 +1,265 @@
+""" @file supervisor.py
+    @author Sean Duffie
+    @brief Sharded monitoring of many clans across worker processes
+
+    clashbot.py follows every clan with one coc.EventsClient in one process, so with
+    dozens of clans its event loop and its sqlite writer become the bottleneck. In
+    supervisor mode the clans are split across N worker processes, each with its own
+    EventsClient and trophy coalescer. Workers only build records and put them on one
+    shared multiprocessing queue, and the supervisor process is the single writer: a
+    DatabaseWriter drains that queue into stats.db. Per shard throughput (events and
+    records per second, drops) is logged every report interval, and a shard that dies
+    is restarted.
+
+    The Discord bot (channels, commands, announcements) stays in clashbot.py.
+
+    Usage:
+        python supervisor.py --shards 4 "#2Y0YRGG0" "#8QU8J9LP" "#2LQGUYYQJ"
+"""
+import argparse
+import asyncio
+import datetime
+import logging
+import multiprocessing
+import os
+import queue
+import sys
+import time
+from typing import List
+
+import coc
+from dotenv import load_dotenv
+
+import log_format
+from database import PERFORMANCE_PROFILE, Database, DatabaseWriter
+from recorder import EventRecorder
+from schema import MIGRATIONS
+
+### PATH SECTION ###
+RTDIR = os.path.dirname(__file__)
+DBDIR = os.path.join(RTDIR, "data")
+LOGDIR = os.path.join(RTDIR, "logs")
+ENVDIR = os.path.join(RTDIR, ".env")
+
+logger = logging.getLogger("Clash")
+
+
+def shard_clans(clan_tags: List[str], shards: int) -> List[List[str]]:
+    """ Splits the clans into at most `shards` groups of nearly equal size
+
+    Tags are sorted first, so the same list always gives the same shards.
+
+    Args:
+        clan_tags (List[str]): every clan being monitored
+        shards (int): number of worker processes
+
+    Returns:
+        List[List[str]]: clan tags per shard, without empty shards
+    """
+    ordered = sorted(set(clan_tags))
+    return [ordered[i::shards] for i in range(min(shards, len(ordered)))]
+
+
+class ShardStats():
+    """ Counters a worker updates in shared memory and the supervisor reads
+
+    Each counter is only ever written by its own worker, so no locks are needed.
+    """
+    def __init__(self, ctx) -> None:
+        """ Constructor for the counters
+
+        Args:
+            ctx (multiprocessing.context.BaseContext): context the workers are started from
+        """
+        self.events = ctx.RawValue("q", 0)
+        self.records = ctx.RawValue("q", 0)
+        self.dropped = ctx.RawValue("q", 0)
+
+    def snapshot(self) -> dict:
+        """ Current counter values
+
+        Returns:
+            dict: events, records and dropped totals since the worker started
+        """
+        return {"events": self.events.value, "records": self.records.value, "dropped": self.dropped.value}
+
+
+async def shard_main(shard_id: int, clan_tags: List[str], items, stats: ShardStats, window: int) -> None:
+    """ Follows one shard of clans and puts their records on the writer's queue
+
+    Args:
+        shard_id (int): index of this shard, for logging
+        clan_tags (List[str]): clans followed by this worker
+        items (multiprocessing.Queue): the writer's queue
+        stats (ShardStats): this worker's counters
+        window (int): trophy coalescing window in seconds
+    """
+    def submit(record) -> bool:
+        try:
+            items.put_nowait((None, record, None))
+        except queue.Full:
+            stats.dropped.value += 1
+            if stats.dropped.value == 1 or stats.dropped.value % 1000 == 0:
+                logger.warning("Shard %d: writer queue full (%d dropped)", shard_id, stats.dropped.value)
+            return False
+        stats.records.value += 1
+        return True
+
+    recorder = EventRecorder(submit, window=window)
+
+    # Same records as clashbot.py's handlers, see recorder.EventRecorder
+    @coc.ClanEvents.member_donations()
+    async def on_donation(old_member: coc.ClanMember, new_member: coc.ClanMember):
+        stats.events.value += 1
+        recorder.donated(old_member, new_member)
+
+    @coc.ClanEvents.member_received()
+    async def on_received(old_member: coc.ClanMember, new_member: coc.ClanMember):
+        stats.events.value += 1
+        recorder.received(old_member, new_member)
+
+    @coc.ClanEvents.member_trophies()
+    async def on_trophies(old_member: coc.ClanMember, new_member: coc.ClanMember):
+        stats.events.value += 1
+        recorder.trophies(old_member, new_member)
+
+    @coc.ClanEvents.member_join()
+    async def on_join(member: coc.ClanMember, clan: coc.Clan):
+        stats.events.value += 1
+        recorder.joined(member, clan)
+
+    @coc.ClanEvents.member_leave()
+    async def on_leave(member: coc.ClanMember, clan: coc.Clan):
+        stats.events.value += 1
+        recorder.left(member, clan)
+
+    async with coc.EventsClient() as coc_client:
+        try:
+            await coc_client.login(os.getenv("DEV_EMAIL"), os.getenv("DEV_PASSWORD"))
+        except coc.InvalidCredentials as error:
+            sys.exit(error)
+
+        coc_client.add_clan_updates(*clan_tags)
+        # Only reads, the roster changes go through the supervisor's writer like every other record
+        roster_db = Database("stats.db", DBDIR)
+        try:
+            await recorder.follow(coc_client, clan_tags, roster_db.roster_members)
+        finally:
+            roster_db.close()
+        coc_client.add_events(on_donation, on_received, on_trophies, on_join, on_leave)
+        logger.info("Shard %d following %d clans: %s", shard_id, len(clan_tags), ", ".join(clan_tags))
+
+        try:
+            ticks = 0
+            while True:
+                if ticks % 3 == 0:
+                    recorder.scheduler.apply(coc_client)
+                ticks += 1
+                await asyncio.sleep(10)
+                recorder.flush_due()
+        finally:
+            recorder.flush_all()
+
+
+def run_shard(shard_id: int, clan_tags: List[str], items, stats: ShardStats, window: int):
+    """ Worker process entry point
+
+    Args:
+        see shard_main()
+    """
+    logname = os.path.join(LOGDIR, f'shard{shard_id}_{datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}.log')
+    log_format.format_logs(logger_name="Clash", file_name=logname, level=logging.INFO)
+    try:
+        asyncio.run(shard_main(shard_id, clan_tags, items, stats, window))
+    except KeyboardInterrupt:
+        pass
+
+
+def supervise(clan_tags: List[str], shards: int, window: int = 60, max_queue: int = 50000,
+              report_every: int = 60):
+    """ Starts the writer and one worker per shard, then reports on them until interrupted
+
+    Workers are spawned rather than forked, so they start without the supervisor's
+    sqlite connection or writer thread.
+
+    Args:
+        clan_tags (List[str]): every clan to monitor
+        shards (int): number of worker processes
+        window (int, optional): trophy coalescing window in seconds. Defaults to 60.
+        max_queue (int, optional): records allowed to wait for the writer. Defaults to 50000.
+        report_every (int, optional): seconds between stats reports. Defaults to 60.
+    """
+    if shards < 1 or not clan_tags:
+        raise ValueError(f"Need at least one shard and one clan, got {shards} shards for {len(clan_tags)} clans")
+
+    db = Database("stats.db", DBDIR, profile=PERFORMANCE_PROFILE)
+    if not db.migrate(MIGRATIONS):
+        sys.exit("Database migration failed, see the log for details")
+    db.close()
+
+    ctx = multiprocessing.get_context("spawn")
+    items = ctx.Queue(maxsize=max_queue)
+    writer = DatabaseWriter("stats.db", DBDIR, batch_rows=500, batch_ms=2000, profile=PERFORMANCE_PROFILE,
+                            items=items)
+    writer.start()
+
+    def launch(shard_id: int, tags: List[str], stats: ShardStats):
+        proc = ctx.Process(target=run_shard, args=(shard_id, tags, items, stats, window), name=f"shard{shard_id}")
+        proc.start()
+        return proc
+
+    workers = []
+    for shard_id, tags in enumerate(shard_clans(clan_tags, shards)):
+        stats = ShardStats(ctx)
+        workers.append([launch(shard_id, tags, stats), tags, stats, stats.snapshot()])
+    logger.info("Supervising %d clans across %d shards", len(clan_tags), len(workers))
+
+    try:
+        last = time.monotonic()
+        while True:
+            time.sleep(report_every)
+            now = time.monotonic()
+            elapsed = now - last
+            last = now
+            for shard_id, worker in enumerate(workers):
+                proc, tags, stats, previous = worker
+                current = stats.snapshot()
+                logger.info("Shard %d (%d clans): %.1f events/s, %.1f records/s, %d dropped",
+                            shard_id, len(tags), (current["events"] - previous["events"]) / elapsed,
+                            (current["records"] - previous["records"]) / elapsed, current["dropped"])
+                worker[3] = current
+                if not proc.is_alive():
+                    logger.error("Shard %d exited with code %s, restarting", shard_id, proc.exitcode)
+                    worker[0] = launch(shard_id, tags, stats)
+            logger.info("Writer: %s", writer.stats())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # The workers got the same interrupt, give them time to flush their coalescers
+        for proc, _, _, _ in workers:
+            proc.join(timeout=15)
+            if proc.is_alive():
+                proc.terminate()
+        writer.stop(timeout=30)
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description="Monitor many clans with sharded worker processes")
+    PARSER.add_argument("clans", nargs="*", help="clan tags, defaults to CLAN_TAGS (comma separated) in .env")
+    PARSER.add_argument("--shards", type=int, default=os.cpu_count() or 2)
+    PARSER.add_argument("--window", type=int, default=60, help="trophy coalescing window in seconds")
+    PARSER.add_argument("--report", type=int, default=60, help="seconds between stats reports")
+    ARGS = PARSER.parse_args()
+    if ARGS.shards < 1:
+        PARSER.error("--shards must be at least 1")
+
+    load_dotenv(dotenv_path=ENVDIR)
+    if not os.getenv("DEV_EMAIL") or not os.getenv("DEV_PASSWORD"):
+        sys.exit("DEV_EMAIL/DEV_PASSWORD missing from .env, run clashbot.py once to set them up")
+    CLANS = ARGS.clans or [tag for tag in os.getenv("CLAN_TAGS", os.getenv("CLAN_TAG", "")).split(",") if tag]
+    if not CLANS:
+        sys.exit("No clans to monitor")
+
+    logname = os.path.join(LOGDIR, f'supervisor_{datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}.log')
+    log_format.format_logs(logger_name="Clash", file_name=logname, level=logging.INFO)
+    supervise(CLANS, ARGS.shards, window=ARGS.window, report_every=ARGS.report)
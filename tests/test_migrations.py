@@ -0,0 +1,138 @@
+""" @file test_migrations.py
+    @author Sean Duffie
+    @brief Migrates a database in the original (baseline) format and checks the result
+
+    The baseline bot created roster, trophies and donations exactly as below and wrote
+    Date as local datetime.now() text with tags and names on every row.
+
+    Run from the repository root with: python -m pytest -q tests
+"""
+import datetime
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database   # noqa: E402
+from schema import MIGRATIONS   # noqa: E402
+
+BASELINE_TABLES = [
+    "CREATE TABLE roster (COC text, Discord text)",
+    """CREATE TABLE trophies (Date text, Clan text, PlayerTag text, PlayerName text,
+                              Trophies int)""",
+    """CREATE TABLE donations (Date text, Clan text, DonorTag text, DonorName text,
+                               RecipientTag text, RecipientName text, Amount int)"""
+]
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def baseline_db(path: str, roster: list) -> None:
+    """ Writes a database file the way the baseline clashbot.py did
+
+    Args:
+        path (str): database file
+        roster (list): (COC, Discord) rows
+    """
+    con = sqlite3.connect(path)
+    for sql in BASELINE_TABLES:
+        con.execute(sql)
+    con.executemany("INSERT INTO roster VALUES (?, ?)", roster)
+    con.executemany("INSERT INTO trophies VALUES (?, ?, ?, ?, ?)", [
+        ("2024-03-01 10:00:00", "#CLAN", "#P1", "Alice", 5000),
+        ("2024-03-01 18:30:00", "#CLAN", "#P1", "Alice", 5030),
+        ("2024-03-02 09:15:00", "#CLAN", "#P2", "Bob", 4200)
+    ])
+    con.executemany("INSERT INTO donations VALUES (?, ?, ?, ?, ?, ?, ?)", [
+        ("2024-03-01 11:00:00", "#CLAN", "#P1", "Alice", None, None, 20),
+        ("2024-03-01 11:00:05", "#CLAN", None, None, "#P2", "Bob", 20),
+        ("2024-03-01 12:00:00", "#CLAN", "#P1", "Alice", None, None, 5)
+    ])
+    con.commit()
+    con.close()
+
+
+def epoch(text: str) -> int:
+    """ Epoch seconds of a baseline (local time) date string """
+    return int(datetime.datetime.strptime(text, DATE_FORMAT).timestamp())
+
+
+def test_baseline_migration(tmp_path):
+    """ Dates become epoch integers, tags become ids and the rollups are backfilled """
+    baseline_db(str(tmp_path / "stats.db"), [("#P1", "alice#1"), ("#P1", None), ("#P2", "bob#2")])
+    db = Database("stats.db", str(tmp_path))
+    assert db.migrate(MIGRATIONS)
+    assert db.schema_version() == max(version for version, _, _ in MIGRATIONS)
+
+    con = db.con
+    types = {info[1]: info[2].lower() for info in con.execute("PRAGMA table_info(trophies)")}
+    assert types["Date"] == "integer"
+    assert "PlayerTag" not in types and "PlayerId" in types
+
+    players = dict(con.execute("SELECT Tag, PlayerId FROM players"))
+    assert set(players) == {"#P1", "#P2"}
+    assert dict(con.execute("SELECT PlayerId, Name FROM players")) == {players["#P1"]: "Alice",
+                                                                      players["#P2"]: "Bob"}
+    assert [tag for tag, in con.execute("SELECT Tag FROM clans")] == ["#CLAN"]
+
+    trophies = con.execute("SELECT Date, PlayerId, Trophies FROM trophies ORDER BY Date").fetchall()
+    assert trophies == [
+        (epoch("2024-03-01 10:00:00"), players["#P1"], 5000),
+        (epoch("2024-03-01 18:30:00"), players["#P1"], 5030),
+        (epoch("2024-03-02 09:15:00"), players["#P2"], 4200)
+    ]
+    donations = con.execute("SELECT Date, DonorId, RecipientId, Amount FROM donations ORDER BY Date").fetchall()
+    assert donations == [
+        (epoch("2024-03-01 11:00:00"), players["#P1"], None, 20),
+        (epoch("2024-03-01 11:00:05"), None, players["#P2"], 20),
+        (epoch("2024-03-01 12:00:00"), players["#P1"], None, 5)
+    ]
+
+    # Rollups are backfilled from the migrated history, one row per player per UTC day.
+    # Which local times share a UTC day depends on the time zone, so bucket the raw rows here
+    expected = {}
+    for date, player, trophies in con.execute("SELECT Date, PlayerId, Trophies FROM trophies ORDER BY Date"):
+        row = expected.setdefault((player, date // 86400 * 86400), [0, 0, None, None, None])
+        row[2:] = [min(trophies, row[2] or trophies), max(trophies, row[3] or trophies), trophies]
+    for date, donor, recipient, amount in donations:
+        player, column = (donor, 0) if donor is not None else (recipient, 1)
+        expected.setdefault((player, date // 86400 * 86400), [0, 0, None, None, None])[column] += amount
+    daily = {(row[0], row[1]): list(row[2:]) for row in con.execute(
+        "SELECT PlayerId, Date, Donated, Received, TrophyMin, TrophyMax, TrophyLast FROM player_daily")}
+    assert daily == expected
+    assert sum(row[0] for row in daily.values()) == 25
+
+    # The named views show the baseline columns again
+    named = db.query_df("SELECT PlayerTag, PlayerName, Trophies FROM trophies_named ORDER BY Date")
+    assert named["PlayerTag"].tolist() == ["#P1", "#P1", "#P2"]
+
+    # The two #P1 roster rows agree, so they are merged and the Discord link is kept
+    assert con.execute("SELECT COC, Discord FROM roster ORDER BY COC").fetchall() == [("#P1", "alice#1"),
+                                                                                    ("#P2", "bob#2")]
+    db.close()
+
+    # Up to date, so migrating again changes nothing
+    db = Database("stats.db", str(tmp_path))
+    assert db.migrate(MIGRATIONS)
+    assert db.con.execute("SELECT count(*) FROM trophies").fetchone()[0] == 3
+    db.close()
+
+
+def test_conflicting_roster_stops_migration(tmp_path):
+    """ Two Discord links for one account can't be merged, so the rows are kept for fixing by hand """
+    baseline_db(str(tmp_path / "stats.db"), [("#P1", "alice#1"), ("#P1", "someone#9")])
+    db = Database("stats.db", str(tmp_path))
+    assert not db.migrate(MIGRATIONS)
+    assert db.schema_version() < max(version for version, _, _ in MIGRATIONS)
+    assert sorted(db.con.execute("SELECT Discord FROM roster WHERE COC = '#P1'")) == [("alice#1",), ("someone#9",)]
+    db.close()
+
+    # Once the conflict is resolved the next startup finishes the migration
+    con = sqlite3.connect(str(tmp_path / "stats.db"))
+    con.execute("DELETE FROM roster WHERE Discord = 'someone#9'")
+    con.commit()
+    con.close()
+    db = Database("stats.db", str(tmp_path))
+    assert db.migrate(MIGRATIONS)
+    assert db.con.execute("SELECT count(*) FROM roster").fetchone()[0] == 1
+    db.close()